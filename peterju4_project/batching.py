@@ -0,0 +1,126 @@
+from entity_processing import EntityProcessing, ContentValidation
+from etags import ETag
+import json
+import logging
+import constants
+
+
+logger = logging.getLogger(__name__)
+
+# Datastore accepts at most 500 keys/entities per get_multi/put_multi/delete_multi call
+MAX_BATCH_SIZE = 500
+
+
+def chunked(items, size=MAX_BATCH_SIZE):
+    """
+    Splits an iterable into lists of at most `size` items
+    :param items: any iterable
+    :param size: maximum length of each chunk
+    :return: generator of lists
+    """
+    chunk = []
+    for item in items:
+        chunk.append(item)
+        if len(chunk) == size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+class BatchOperations:
+
+    @staticmethod
+    def delete_all(repo, batch_size=MAX_BATCH_SIZE, progress=None):
+        """
+        Deletes every entity of a kind with a keys-only query and one delete_multi per batch.
+        Safe to re-run after an interruption: it simply continues with whatever is left.
+        :param repo: storage.Repository of the kind to wipe
+        :param batch_size: keys per delete_multi call
+        :param progress: optional callable receiving the number of entities deleted so far
+        :return: number of entities deleted
+        """
+        deleted = 0
+        for batch in chunked(repo.iterate(keys_only=True, batch_size=batch_size), batch_size):
+            repo.delete_multi([e.key.id_or_name for e in batch])
+            deleted += len(batch)
+            logger.info("Deleted %d %s", deleted, repo.kind)
+            if progress:
+                progress(deleted)
+        return deleted
+
+    @staticmethod
+    def parse_items(request):
+        """
+        Reads the items of a batch request: a JSON array, or one JSON object per line with
+        Content-Type: application/x-ndjson
+        :param request: flask request
+        :return: list of items. raises ValueError with a message for the client if the body is malformed.
+        """
+        if request.mimetype == "application/x-ndjson":
+            try:
+                items = [json.loads(line) for line in request.get_data(as_text=True).splitlines() if line.strip()]
+            except ValueError:
+                raise ValueError("Each line of the request body must be a JSON object")
+        else:
+            items = request.get_json(silent=True)
+            if not isinstance(items, list):
+                raise ValueError("The request body must be a JSON array or NDJSON")
+        if len(items) > constants.MAX_BATCH_ITEMS:
+            raise ValueError(f'A batch can hold at most {constants.MAX_BATCH_ITEMS} items')
+        return items
+
+    @staticmethod
+    def create_all(repo, items, extra_attributes=None):
+        """
+        Validates every item with the single-entity rules, allocates ids for the valid ones in one call and writes
+        them with chunked put_multi.
+        :param repo: storage.Repository of the kind to create ("restaurants" or "employees")
+        :param items: request JSON objects
+        :param extra_attributes: attributes added to every valid item after validation, e.g. the owner
+        :return: one result per item, in order: the created entity, or an error dict with its status code
+        """
+        results = [None] * len(items)
+        valid = []
+        for index, content in enumerate(items):
+            if not isinstance(content, dict):
+                results[index] = ({"Error": "Each item must be a JSON object"}, 400)
+                continue
+            try:
+                content_error = ContentValidation.validation_all_attributes(content, repo.kind)
+            except TypeError:
+                content_error = {"Error": "The request object has attributes of the wrong type"}, 400
+            if content_error:
+                results[index] = content_error
+                continue
+            content.update(extra_attributes or {})
+            valid.append((index, content))
+
+        if not valid:
+            return results
+
+        entities = []
+        for (index, content), id in zip(valid, repo.allocate_ids(len(valid))):
+            entity = EntityProcessing.update_entity_all(content, repo.kind, repo.new(id))
+            entities.append(entity)
+            results[index] = entity
+        repo.put_multi(entities)
+        return results
+
+    @staticmethod
+    def describe_results(results, self_url):
+        """
+        :param results: return value of create_all
+        :param self_url: url prefix of the created entities, e.g. "http://host/restaurants/"
+        :return: response body with one entry per item, carrying its index and status code
+        """
+        output = []
+        for index, result in enumerate(results):
+            if isinstance(result, tuple):
+                error, status = result
+                output.append({"index": index, "status": status, **error})
+            else:
+                output.append({"index": index, "status": 201, **ETag.strip(result),
+                               "id": result.key.id, "self": f'{self_url}{result.key.id}'})
+        created = sum(1 for item in output if item["status"] == 201)
+        return {"created": created, "failed": len(output) - created, "results": output}
@@ -0,0 +1,246 @@
+"""
+Micro-benchmarks for the entity_processing helpers that run on every write, and for the serialization of list
+responses.
+
+    python benchmarks.py                         # run and print
+    python benchmarks.py --save                  # run and store the results as the baseline
+    python benchmarks.py --compare               # run and fail if anything got slower than the baseline allows
+    python benchmarks.py --compare --max-slowdown 0.10 --filter roster
+
+Baselines are machine specific: record one on the machine the comparison runs on.
+"""
+from google.cloud import datastore
+import argparse
+import json
+import os
+import platform
+import statistics
+import sys
+import timeit
+
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from entity_processing import EntityProcessing, ContentValidation
+from fields import Fieldsets
+import constants
+
+
+BASELINE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "benchmark_baseline.json")
+ROSTER_SIZES = (10, 100, 1000, 10000)
+HOST_URL = "http://localhost:8080/"
+
+
+class FakeRequest:
+    host_url = HOST_URL
+
+
+def _key(kind, id):
+    return datastore.Key(kind, id, project="benchmarks")
+
+
+def make_employee(id, workplace=None):
+    employee = datastore.Entity(key=_key(constants.employees, id))
+    employee.update({"name": f'Employee {id}', "wage": 15.20, "position": "Line Cook", "workplace": workplace})
+    return employee
+
+
+def make_restaurant(id, roster_size):
+    restaurant = datastore.Entity(key=_key(constants.restaurants, id))
+    restaurant.update({"name": f'Restaurant {id}', "cost": "$$", "cuisine": "Thai", "owner": "auth0|benchmarks"})
+    restaurant["employee_count"] = roster_size
+    return restaurant
+
+
+# payload mixes: valid bodies and the rejections the Postman collection exercises
+RESTAURANT_PAYLOADS = [
+    {"name": "Ivan's", "cost": "$$$", "cuisine": "Italian"},
+    {"name": "Ivan's", "cost": "$$$"},
+    {"name": "Ivan's", "cost": "$$$", "cuisine": "Italian", "location": "Seattle"},
+    {"name": "Ivan's", "cost": "$$$$$", "cuisine": "Italian"}
+]
+EMPLOYEE_PAYLOADS = [
+    {"name": "Carlos Cruz", "wage": 15.20, "position": "Line Cook"},
+    {"name": "Carlos Cruz", "wage": 15.20},
+    {"name": "Carlos Cruz", "wage": 12.00, "position": "Line Cook"},
+    {"name": "Carlos Cruz", "wage": 15.20, "position": "Line Cook", "shift": "night"}
+]
+PATCH_PAYLOADS = [
+    ({"cost": "$$"}, constants.restaurants),
+    ({"name": "Indulge", "cost": "$$$$", "cuisine": "Thai"}, constants.restaurants),
+    ({"position": "Dishwasher", "wage": 14.40}, constants.employees),
+    ({"wage": 10.00}, constants.employees)
+]
+
+
+def validation_all_attributes():
+    for payload in RESTAURANT_PAYLOADS:
+        ContentValidation.validation_all_attributes(payload, constants.restaurants)
+    for payload in EMPLOYEE_PAYLOADS:
+        ContentValidation.validation_all_attributes(payload, constants.employees)
+
+
+def validation_some_attributes():
+    for payload, kind in PATCH_PAYLOADS:
+        ContentValidation.validation_some_attributes(payload, kind)
+
+
+def update_entity_all():
+    EntityProcessing.update_entity_all(dict(RESTAURANT_PAYLOADS[0]), constants.restaurants,
+                                       datastore.Entity(key=_key(constants.restaurants, 1)))
+    EntityProcessing.update_entity_all(dict(EMPLOYEE_PAYLOADS[0]), constants.employees,
+                                       datastore.Entity(key=_key(constants.employees, 1)))
+
+
+def roster_benchmarks(roster_size):
+    """
+    :return: benchmarks operating on a restaurant with roster_size employees
+    """
+    restaurant = make_restaurant(1, roster_size)
+    # the last employee hired: the worst case back when rosters were scanned linearly
+    workplace = {"id": 1, "name": restaurant["name"], "self": f'{HOST_URL}restaurants/1'}
+    last_employee = make_employee(roster_size, workplace)
+    new_employee = make_employee(roster_size + 1)
+    request = FakeRequest()
+
+    def link_restaurant_and_employee():
+        EntityProcessing.link_restaurant_and_employee(restaurant, new_employee, request)
+        restaurant["employee_count"] -= 1
+        new_employee["workplace"] = None
+
+    def remove_employee_from_restaurant():
+        EntityProcessing.remove_employee_from_restaurant(last_employee, restaurant)
+        restaurant["employee_count"] += 1
+        last_employee["workplace"] = workplace
+
+    def validation_employee_removal():
+        ContentValidation.validation_employee_removal(last_employee, restaurant)
+
+    def serialize_restaurant():
+        json.dumps(restaurant)
+
+    return {
+        f'link_restaurant_and_employee[roster={roster_size}]': link_restaurant_and_employee,
+        f'remove_employee_from_restaurant[roster={roster_size}]': remove_employee_from_restaurant,
+        f'validation_employee_removal[roster={roster_size}]': validation_employee_removal,
+        f'serialize_restaurant[roster={roster_size}]': serialize_restaurant
+    }
+
+
+def list_serialization_benchmarks():
+    """
+    :return: benchmarks serializing list responses the way restaurants_post_get/employees_get_post do
+    """
+    benchmarks = {}
+    for limit, roster_size in ((5, 0), (5, 100), (100, 10), (100, 100)):
+        restaurants = []
+        for i in range(1, limit + 1):
+            restaurant = make_restaurant(i, roster_size)
+            restaurant["id"] = i
+            restaurant["self"] = f'{HOST_URL}restaurants/{i}'
+            restaurants.append(restaurant)
+        output = {"count": 1000, "restaurants": restaurants, "next": f'{HOST_URL}restaurants?limit={limit}'}
+        benchmarks[f'serialize_restaurant_list[limit={limit},roster={roster_size}]'] = \
+            lambda output=output: json.dumps(output)
+
+    for limit in (5, 100, 1000):
+        employees = []
+        for i in range(1, limit + 1):
+            employee = make_employee(i, {"id": 1, "name": "Restaurant 1", "self": f'{HOST_URL}restaurants/1'})
+            employee["id"] = i
+            employee["self"] = f'{HOST_URL}employees/{i}'
+            employees.append(employee)
+        output = {"count": 1000, "employees": employees}
+        benchmarks[f'serialize_employee_list[limit={limit}]'] = lambda output=output: json.dumps(output)
+
+    # ?fields= trims each row before serialization
+    restaurants = [make_restaurant(i, 10) for i in range(1, 101)]
+    for fields in (["name", "id"], ["name", "cost", "cuisine", "id", "self"]):
+        def serialize_fieldset(fields=fields):
+            rows = [Fieldsets.render(e, fields, f'{HOST_URL}restaurants/') for e in restaurants]
+            json.dumps({"count": 1000, "restaurants": rows})
+        benchmarks[f'serialize_restaurant_list[limit=100,fields={",".join(fields)}]'] = serialize_fieldset
+    return benchmarks
+
+
+def all_benchmarks():
+    benchmarks = {
+        "validation_all_attributes[mix=8]": validation_all_attributes,
+        "validation_some_attributes[mix=4]": validation_some_attributes,
+        "update_entity_all[restaurant+employee]": update_entity_all
+    }
+    for roster_size in ROSTER_SIZES:
+        benchmarks.update(roster_benchmarks(roster_size))
+    benchmarks.update(list_serialization_benchmarks())
+    return benchmarks
+
+
+def measure(function, repeat=5, min_time=0.2):
+    """
+    :return: median and best time per call in microseconds over `repeat` rounds of at least min_time seconds
+    """
+    timer = timeit.Timer(function)
+    number, _ = timer.autorange()
+    number = max(int(number * min_time / 0.2), 1)
+    rounds = [elapsed / number * 1e6 for elapsed in timer.repeat(repeat=repeat, number=number)]
+    return {"median_us": statistics.median(rounds), "best_us": min(rounds), "calls": number}
+
+
+def compare(results, baseline, max_slowdown):
+    """
+    :param results: fresh results
+    :param baseline: stored results
+    :param max_slowdown: allowed relative slowdown of the median, e.g. 0.25 = 25% slower
+    :return: names of the benchmarks that regressed
+    """
+    regressions = []
+    for name, result in results.items():
+        if name not in baseline:
+            continue
+        ratio = result["median_us"] / baseline[name]["median_us"]
+        flag = ""
+        if ratio > 1 + max_slowdown:
+            regressions.append(name)
+            flag = "  REGRESSION"
+        print(f'{name:<60}{baseline[name]["median_us"]:>12.2f}{result["median_us"]:>12.2f}{ratio:>9.2f}x{flag}')
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Micro-benchmarks for the entity_processing hot paths")
+    parser.add_argument("--filter", help="only run benchmarks whose name contains this string")
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--baseline", default=BASELINE, help="baseline JSON file")
+    parser.add_argument("--save", action="store_true", help="store the results as the baseline")
+    parser.add_argument("--compare", action="store_true", help="compare against the baseline")
+    parser.add_argument("--max-slowdown", type=float, default=0.25,
+                        help="relative slowdown of the median that fails --compare (default 0.25)")
+    args = parser.parse_args(argv)
+
+    results = {}
+    for name, function in all_benchmarks().items():
+        if args.filter and args.filter not in name:
+            continue
+        results[name] = measure(function, repeat=args.repeat)
+        if not args.compare:
+            print(f'{name:<60}{results[name]["median_us"]:>12.2f} us  (best {results[name]["best_us"]:.2f})')
+
+    if args.save:
+        with open(args.baseline, "w") as baseline_file:
+            json.dump({"python": platform.python_version(), "machine": platform.machine(), "results": results},
+                      baseline_file, indent=2)
+        print(f'Saved baseline to {args.baseline}')
+
+    if args.compare:
+        with open(args.baseline) as baseline_file:
+            baseline = json.load(baseline_file)["results"]
+        print(f'{"benchmark":<60}{"base us":>12}{"now us":>12}{"ratio":>10}')
+        regressions = compare(results, baseline, args.max_slowdown)
+        if regressions:
+            print(f'{len(regressions)} benchmark(s) slowed down by more than {args.max_slowdown:.0%}')
+            return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,102 @@
+from collections import OrderedDict
+import threading
+import time
+
+
+class LRUCache:
+    """
+    Thread-safe, size-bounded LRU cache whose entries can each carry their own expiry time.
+    """
+
+    def __init__(self, max_size, ttl=None):
+        """
+        :param max_size: maximum number of entries; the least recently used entry is evicted past this
+        :param ttl: default lifetime of an entry in seconds (None = no expiry)
+        """
+        self.max_size = max_size
+        self.ttl = ttl
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+
+    def get(self, key, default=None):
+        """
+        :param key: cache key
+        :param default: returned when the key is missing or expired
+        :return: the cached value
+        """
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return default
+            value, expires_at = entry
+            if expires_at is not None and time.time() >= expires_at:
+                del self._entries[key]
+                self.expirations += 1
+                self.misses += 1
+                return default
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def peek(self, key, default=None):
+        """
+        Looks a key up without counting a hit or miss and without refreshing its recency, for callers that only
+        check what another component cached
+        :param key: cache key
+        :param default: returned when the key is missing or expired
+        :return: the cached value
+        """
+        with self._lock:
+            entry = self._entries.get(key)
+        if entry is None:
+            return default
+        value, expires_at = entry
+        if expires_at is not None and time.time() >= expires_at:
+            return default
+        return value
+
+    def set(self, key, value, expires_at=None):
+        """
+        :param key: cache key
+        :param value: value to cache
+        :param expires_at: absolute unix time the entry expires at; defaults to now + ttl
+        """
+        if expires_at is None and self.ttl is not None:
+            expires_at = time.time() + self.ttl
+        with self._lock:
+            self._entries[key] = (value, expires_at)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def delete(self, key):
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def stats(self):
+        """
+        :return: hit/miss counters and current size of the cache
+        """
+        lookups = self.hits + self.misses
+        return {
+            "size": len(self._entries),
+            "max_size": self.max_size,
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "expirations": self.expirations,
+            "hit_ratio": self.hits / lookups if lookups else 0.0
+        }
@@ -0,0 +1,131 @@
+from flask import request
+from etags import ETag
+from metrics import compression_bytes, compression_cpu
+import time
+import zlib
+import constants
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+
+COMPRESSIBLE = ("application/json", "application/x-ndjson")
+
+
+class _Encoder:
+    """
+    Incremental gzip or brotli encoder
+    """
+
+    def __init__(self, encoding):
+        self.encoding = encoding
+        if encoding == "br":
+            self._compressor = brotli.Compressor(quality=constants.COMPRESSION_BROTLI_QUALITY)
+        else:
+            # wbits 31: zlib deflate with a gzip header and trailer
+            self._compressor = zlib.compressobj(constants.COMPRESSION_LEVEL, zlib.DEFLATED, 31)
+
+    def compress(self, data):
+        if self.encoding == "br":
+            return self._compressor.process(data)
+        return self._compressor.compress(data)
+
+    def finish(self):
+        if self.encoding == "br":
+            return self._compressor.finish()
+        return self._compressor.flush()
+
+
+def _record(encoding, cpu, size_in, size_out):
+    compression_cpu.observe(cpu, encoding=encoding)
+    compression_bytes.inc(size_in, encoding=encoding, direction="in")
+    compression_bytes.inc(size_out, encoding=encoding, direction="out")
+
+
+def _stream(encoder, chunks):
+    """
+    Compresses a streamed body as it is produced. Output is emitted whenever the compressor has some, so large
+    exports go out in compressed blocks without being buffered whole.
+    """
+    cpu = 0.0
+    size_in = size_out = 0
+    try:
+        for chunk in chunks:
+            started = time.thread_time()
+            data = encoder.compress(chunk)
+            cpu += time.thread_time() - started
+            size_in += len(chunk)
+            size_out += len(data)
+            if data:
+                yield data
+        started = time.thread_time()
+        data = encoder.finish()
+        cpu += time.thread_time() - started
+        size_out += len(data)
+        yield data
+    finally:
+        _record(encoder.encoding, cpu, size_in, size_out)
+
+
+class Compression:
+    """
+    Flask extension compressing JSON, NDJSON and text responses with the best encoding the client accepts
+    (brotli if the optional brotli package is installed, then gzip). Bodies smaller than COMPRESSION_MIN_SIZE
+    are sent as they are; streamed bodies are always compressed, chunk by chunk.
+
+    Register it after Metrics so the response sizes recorded there are the compressed ones.
+    """
+
+    def __init__(self, app=None):
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        app.after_request(self._after_request)
+
+    @staticmethod
+    def _encoding():
+        available = ["br", "gzip"] if brotli is not None else ["gzip"]
+        return request.accept_encodings.best_match(available)
+
+    @staticmethod
+    def _after_request(response):
+        if response.status_code < 200 or response.status_code in (204, 304) or "Content-Encoding" in response.headers:
+            return response
+        # ranges index the identity body, and file responses are passed through as they are (e.g. /profiles/<name>)
+        if response.status_code == 206 or "Content-Range" in response.headers or response.direct_passthrough:
+            return response
+        if response.mimetype not in COMPRESSIBLE and not response.mimetype.startswith("text/"):
+            return response
+        response.vary.add("Accept-Encoding")
+
+        encoding = Compression._encoding()
+        if encoding is None:
+            return response
+        encoder = _Encoder(encoding)
+
+        if response.is_streamed:
+            original = response.response
+            response.response = _stream(encoder, response.iter_encoded())
+            if hasattr(original, "close"):
+                response.call_on_close(original.close)
+            response.headers.pop("Content-Length", None)
+        else:
+            data = response.get_data()
+            if len(data) < constants.COMPRESSION_MIN_SIZE:
+                return response
+            started = time.thread_time()
+            compressed = encoder.compress(data) + encoder.finish()
+            _record(encoding, time.thread_time() - started, len(data), len(compressed))
+            if len(compressed) >= len(data):
+                return response
+            response.set_data(compressed)
+
+        response.headers["Content-Encoding"] = encoding
+        # the compressed bytes differ from the ones the content-hash ETag describes; a coding-specific strong tag
+        # keeps If-Match working, as ETag strips the coding again when comparing
+        if response.headers.get("ETag", "").startswith('"'):
+            response.headers["ETag"] = ETag.encoded(response.headers["ETag"], encoding)
+        return response
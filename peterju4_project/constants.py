@@ -1,3 +1,5 @@
+from os import environ as env
+
 restaurants = "restaurants"
 employees = "employees"
 users = "users"
@@ -7,3 +9,89 @@ CLIENT_SECRET = '6S8BonhQjlDy59eEJdZ3y6L8SnYM4XUUz9jawUEKaSRWD7w2eUerdfWGiEMt_jH
 DOMAIN = 'dev-gju1eibr2s6qfi1f.us.auth0.com'
 
 ALGORITHMS = ["RS256"]
+
+# JWKS key store: set JWKS_FILE to load the keys from a local JWKS document instead of the identity provider
+JWKS_URL = env.get("JWKS_URL", "https://" + DOMAIN + "/.well-known/jwks.json")
+JWKS_FILE = env.get("JWKS_FILE")
+JWKS_TTL = int(env.get("JWKS_TTL", "3600"))
+JWKS_MIN_REFETCH_INTERVAL = int(env.get("JWKS_MIN_REFETCH_INTERVAL", "30"))
+JWKS_FETCH_TIMEOUT = int(env.get("JWKS_FETCH_TIMEOUT", "5"))
+
+# verified JWT payloads kept in memory so repeat requests with the same token skip the signature check
+TOKEN_CACHE_SIZE = int(env.get("TOKEN_CACHE_SIZE", "10000"))
+
+# entity counts maintained by the write paths (see counters.py)
+counters = "counters"
+COUNTER_SHARDS = int(env.get("COUNTER_SHARDS", "10"))
+# attempts at an increment whose transaction collides with a concurrent one on the same shard
+COUNTER_ATTEMPTS = int(env.get("COUNTER_ATTEMPTS", "3"))
+# filtered lists count their matches with a keys-only walk that stops past this many (reported as "count_capped")
+FILTERED_COUNT_LIMIT = int(env.get("FILTERED_COUNT_LIMIT", "1000"))
+
+# subs of users already stored, remembered so return visitors skip the Datastore lookup
+KNOWN_SUBS_CACHE_SIZE = int(env.get("KNOWN_SUBS_CACHE_SIZE", "100000"))
+
+# storage backend behind the blueprints: "datastore" or "memory" (in-process, for load tests and profiling)
+STORAGE_BACKEND = env.get("STORAGE_BACKEND", "datastore")
+
+# largest number of items accepted by POST /restaurants:batch and POST /employees:batch
+MAX_BATCH_ITEMS = int(env.get("MAX_BATCH_ITEMS", "5000"))
+
+# read-through cache of single entities looked up by key; ENTITY_CACHE_SIZE=0 disables it and
+# ENTITY_CACHE_REDIS_URL shares it between workers
+ENTITY_CACHE_SIZE = int(env.get("ENTITY_CACHE_SIZE", "10000"))
+ENTITY_CACHE_TTL = int(env.get("ENTITY_CACHE_TTL", "60"))
+ENTITY_CACHE_KINDS = env.get("ENTITY_CACHE_KINDS", "restaurants,employees").split(",")
+ENTITY_CACHE_REDIS_URL = env.get("ENTITY_CACHE_REDIS_URL")
+
+# kinds whose entities carry a content-hash ETag, refreshed on every write
+ETAG_KINDS = (restaurants, employees)
+
+# entities fetched per query batch by the NDJSON export endpoints
+EXPORT_BATCH_SIZE = int(env.get("EXPORT_BATCH_SIZE", "500"))
+
+# adds a Server-Timing header breaking down where each request's time went (see metrics.py)
+SERVER_TIMING = env.get("SERVER_TIMING", "true").lower() == "true"
+
+# compression of JSON/NDJSON/text responses for clients that accept it (see compression.py); brotli is used
+# when the optional brotli package is installed
+COMPRESSION_MIN_SIZE = int(env.get("COMPRESSION_MIN_SIZE", "1024"))
+COMPRESSION_LEVEL = int(env.get("COMPRESSION_LEVEL", "6"))
+COMPRESSION_BROTLI_QUALITY = int(env.get("COMPRESSION_BROTLI_QUALITY", "4"))
+
+# token-bucket rate limits per subject (verified JWT sub, else client IP) as "<requests per second>:<burst>";
+# RATE_LIMITS overrides them per route, e.g. "GET /restaurants=5:10,POST /restaurants:batch=0.2:2", and an
+# empty RATE_LIMIT_DEFAULT leaves routes without an override unlimited (see ratelimit.py)
+RATE_LIMIT_DEFAULT = env.get("RATE_LIMIT_DEFAULT", "50:100")
+RATE_LIMITS = env.get("RATE_LIMITS", "")
+RATE_LIMIT_KEYS = int(env.get("RATE_LIMIT_KEYS", "100000"))
+RATE_LIMIT_REDIS_URL = env.get("RATE_LIMIT_REDIS_URL")
+# proxies in front of the app that append the address they received a request from to X-Forwarded-For (e.g. 1
+# behind a load balancer); with 0 the client is the peer address of the connection
+RATE_LIMIT_TRUSTED_PROXIES = int(env.get("RATE_LIMIT_TRUSTED_PROXIES", "0"))
+# list requests cost one token per this many rows asked for with ?limit=
+RATE_LIMIT_ROWS_PER_TOKEN = int(env.get("RATE_LIMIT_ROWS_PER_TOKEN", "50"))
+
+# requests handled at once per instance (0 = no cap); past it a request waits for a slot only as long as it can
+# still finish within LATENCY_SLO seconds, otherwise it is shed with a 503
+MAX_CONCURRENT_REQUESTS = int(env.get("MAX_CONCURRENT_REQUESTS", "0"))
+LATENCY_SLO = float(env.get("LATENCY_SLO", "1.0"))
+
+# background jobs (see jobs.py): records of kind "jobs", run by JOB_WORKERS threads per instance; running jobs
+# refresh their record every JOB_HEARTBEAT seconds, and queued/running jobs not refreshed for JOB_STALE_AFTER
+# seconds are resumed when an instance starts (unless JOB_RESUME=false)
+jobs = "jobs"
+JOB_WORKERS = int(env.get("JOB_WORKERS", "4"))
+JOB_HEARTBEAT = int(env.get("JOB_HEARTBEAT", "10"))
+JOB_STALE_AFTER = int(env.get("JOB_STALE_AFTER", "120"))
+JOB_RESUME = env.get("JOB_RESUME", "true").lower() == "true"
+
+# on-demand profiling (see profiling.py): a request carrying PROFILE_TOKEN in an X-Profile header, and a
+# PROFILE_SAMPLE_RATE fraction of all requests, is captured with cProfile and a stack sampler taking a sample
+# every PROFILE_INTERVAL seconds. The newest PROFILE_KEEP captures are kept in PROFILE_DIR and served on
+# /profiles to callers presenting the token; without a token the endpoints are disabled.
+PROFILE_TOKEN = env.get("PROFILE_TOKEN")
+PROFILE_SAMPLE_RATE = float(env.get("PROFILE_SAMPLE_RATE", "0"))
+PROFILE_INTERVAL = float(env.get("PROFILE_INTERVAL", "0.005"))
+PROFILE_DIR = env.get("PROFILE_DIR", "/tmp/profiles")
+PROFILE_KEEP = int(env.get("PROFILE_KEEP", "200"))
@@ -0,0 +1,87 @@
+from google.api_core.exceptions import Conflict
+import logging
+import random
+import storage
+import constants
+
+
+logger = logging.getLogger(__name__)
+
+
+class ShardedCounter:
+    """
+    Entity count of a kind, maintained by the write paths so list endpoints don't have to scan the kind.
+
+    Writers add their deltas to one of `shards` randomly chosen entities of kind "counters" so concurrent
+    writers rarely contend on the same entity. A separate base shard holds the value set by reset(); if it
+    doesn't exist yet (e.g. data written before the counter was introduced) the count is rebuilt once with a
+    keys-only query.
+    """
+
+    def __init__(self, kind, shards=constants.COUNTER_SHARDS):
+        """
+        :param kind: the kind being counted, e.g. constants.restaurants
+        :param shards: number of shard entities
+        """
+        self.kind = kind
+        self.shards = shards
+        self.counter_repo = storage.repository(constants.counters)
+
+    def _shard_name(self, index):
+        return f'{self.kind}-{index}'
+
+    def _new_shard(self, index, value):
+        shard = self.counter_repo.new(self._shard_name(index), exclude_from_indexes=("count",))
+        shard.update({"kind": self.kind, "count": value})
+        return shard
+
+    def increment(self, delta=1):
+        """
+        Adds delta to a randomly chosen shard. A transaction that collides with a concurrent one is retried on
+        another shard; if every attempt fails the count is left as it is and the failure logged, as the entity
+        it counts has already been written.
+        :param delta: amount to add (negative to subtract)
+        """
+        for attempt in range(1, constants.COUNTER_ATTEMPTS + 1):
+            index = random.randrange(1, self.shards + 1)
+            try:
+                with storage.transaction():
+                    shard = self.counter_repo.get(self._shard_name(index))
+                    if shard is None:
+                        shard = self._new_shard(index, 0)
+                    shard["count"] += delta
+                    self.counter_repo.put(shard)
+                return
+            except Conflict:
+                if attempt == constants.COUNTER_ATTEMPTS:
+                    logger.exception("Giving up on adding %d to the %s count after %d attempts", delta, self.kind,
+                                     attempt)
+            except Exception:
+                logger.exception("Adding %d to the %s count failed", delta, self.kind)
+                return
+
+    def value(self):
+        """
+        :return: current number of entities of the kind
+        """
+        shards = self.counter_repo.get_multi([self._shard_name(i) for i in range(self.shards + 1)])
+        if not any(shard.key.name == self._shard_name(0) for shard in shards):
+            return self.rebuild()
+        return max(sum(shard["count"] for shard in shards), 0)
+
+    def reset(self, value=0):
+        """
+        Overwrites the count, e.g. after deleting every entity of the kind
+        :param value: new count
+        """
+        shards = [self._new_shard(i, value if i == 0 else 0) for i in range(self.shards + 1)]
+        self.counter_repo.put_multi(shards)
+
+    def rebuild(self):
+        """
+        Recounts the kind with a keys-only query and stores the result
+        :return: the recounted value
+        """
+        value = sum(1 for _ in storage.repository(self.kind).iterate(keys_only=True))
+        self.reset(value)
+        return value
@@ -1,14 +1,37 @@
-from flask import Blueprint, request
-from google.cloud import datastore
+from contextlib import nullcontext
+from flask import Blueprint, request, Response, stream_with_context
+import storage
+from batching import BatchOperations, chunked
+import jobs
+from counters import ShardedCounter
+from pagination import Pagination, InvalidCursor
+from etags import ETag
+from filters import ListFilters
+from fields import Fieldsets
+from loader import EntityLoader
 from entity_processing import EntityProcessing, ContentValidation
 import json
 import constants
 
 
-client = datastore.Client()
+employee_repo = storage.repository(constants.employees)
+restaurant_repo = storage.repository(constants.restaurants)
+employees_counter = ShardedCounter(constants.employees)
 
 bp = Blueprint('employee', __name__, url_prefix='/employees')
 
+# POST /employees:batch sits next to the collection url rather than under it, so it can't use the url_prefix
+batch_bp = Blueprint('employee_batch', __name__)
+
+
+def _delete_all(progress=None):
+    deleted = BatchOperations.delete_all(employee_repo, progress=progress)
+    employees_counter.reset()
+    return deleted
+
+
+jobs.runner.register("delete-all-employees", _delete_all)
+
 
 @bp.route('/all', methods=['DELETE'])
 def restaurants_delete_all():
@@ -16,14 +39,34 @@ def restaurants_delete_all():
         return {"Error": "This endpoint only supports the return of JSON objects"}, 406
 
     if request.method == "DELETE":
-        query = client.query(kind=constants.employees)
-        results = list(query.fetch())
-        for e in results:
-            employee_key = client.key(constants.employees, int(e.key.id))
-            client.delete(employee_key)
+        # ?background=true runs large wipes as a job that can be polled at /jobs/<id>
+        if request.args.get('background', 'false').lower() == 'true':
+            job = jobs.runner.submit("delete-all-employees")
+            return {"id": job["id"], "self": f'{request.host_url}jobs/{job["id"]}'}, 202
+
+        _delete_all()
         return {"Success": "Deleted all employees"}, 204
 
 
+@batch_bp.route('/employees:batch', methods=['POST'])
+def employees_post_batch():
+    if "application/json" not in request.accept_mimetypes:
+        return {"Error": "This endpoint only supports the return of JSON objects"}, 406
+
+    try:
+        items = BatchOperations.parse_items(request)
+    except ValueError as ex:
+        return {"Error": str(ex)}, 400
+
+    # validate every item, allocate ids in bulk and write with chunked put_multi
+    results = BatchOperations.create_all(employee_repo, items)
+
+    output = BatchOperations.describe_results(results, f'{request.host_url}employees/')
+    if output["created"]:
+        employees_counter.increment(output["created"])
+    return output, 200
+
+
 @bp.route('', methods=['POST', 'GET'])
 def employees_get_post():
     if "application/json" not in request.accept_mimetypes:
@@ -39,49 +82,86 @@ def employees_get_post():
             return content_error
 
         # create
-        new_employee = datastore.entity.Entity(key=client.key(constants.employees))
+        new_employee = employee_repo.new()
 
         # update
         new_employee = EntityProcessing.update_entity_all(content, constants.employees, new_employee)
 
-        client.put(new_employee)
+        employee_repo.put(new_employee)
+        employees_counter.increment()
+        ETag.strip(new_employee)
         new_employee["id"] = new_employee.key.id
         new_employee["self"] = f'{request.host_url}employees/{new_employee.key.id}'
         return new_employee, 201
 
-    # View all employees
+    # View all employees, optionally filtered by position/wage range/unemployed
     elif request.method == 'GET':
-        query = client.query(kind=constants.employees)
-        count = len(list(query.fetch()))
-        q_limit = int(request.args.get('limit', '5'))
-        q_offset = int(request.args.get('offset', '0'))
-        g_iterator = query.fetch(limit=q_limit, offset=q_offset)
-        pages = g_iterator.pages
-        results = list(next(pages))
-        if g_iterator.next_page_token:
-            next_offset = q_offset + q_limit
-            next_url = request.base_url + "?limit=" + str(q_limit) + "&offset=" + str(next_offset)
+        try:
+            query_args = ListFilters.employees(request)
+            # ?fields=name,id returns only those columns, read with a projection or keys-only query when possible
+            fields = Fieldsets.parse(request, constants.employees)
+        except ValueError as ex:
+            return {"Error": str(ex)}, 400
+        query_args.update(Fieldsets.query_args(fields, constants.employees, query_args))
+        try:
+            results, next_url = Pagination.fetch_page(employee_repo, request, **query_args)
+        except InvalidCursor:
+            return {"Error": "The cursor is invalid"}, 400
+        if fields is not None:
+            results = [Fieldsets.render(e, fields, f'{request.host_url}employees/') for e in results]
         else:
-            next_url = None
-        for e in results:
-            e["id"] = e.key.id
-            e["self"] = f'{request.host_url}employees/{e.key.id}'
-        output = {
-            "count": count,
-            "employees": results
-        }
+            for e in results:
+                ETag.strip(e)
+                e["id"] = e.key.id
+                e["self"] = f'{request.host_url}employees/{e.key.id}'
+        output = {}
+        # ?count=false skips the count for callers that don't need it; recommended when paging a filtered list,
+        # whose count walks the matching keys (up to FILTERED_COUNT_LIMIT) on every page
+        if request.args.get('count', 'true').lower() != 'false':
+            counted = ListFilters.count(employee_repo, query_args)
+            output.update(counted if counted is not None else {"count": employees_counter.value()})
+        output["employees"] = results
         if next_url:
             output["next"] = next_url
         return json.dumps(output)
 
 
+@bp.route('/export', methods=['GET'])
+def employees_export():
+    if "application/x-ndjson" not in request.accept_mimetypes and "application/json" not in request.accept_mimetypes:
+        return {"Error": "This endpoint only supports the return of NDJSON"}, 406
+
+    # ?workplace=<restaurant_id> limits the export to one restaurant's employees
+    filters = []
+    workplace = request.args.get('workplace')
+    if workplace:
+        if not workplace.isdigit():
+            return {"Error": "workplace must be a restaurant id"}, 400
+        filters.append(("workplace.id", "=", int(workplace)))
+
+    self_url = f'{request.host_url}employees/'
+
+    def generate():
+        # one cursor-addressed batch in memory at a time, however big the kind is
+        for e in employee_repo.iterate(filters=filters, batch_size=constants.EXPORT_BATCH_SIZE):
+            ETag.strip(e)
+            e["id"] = e.key.id
+            e["self"] = f'{self_url}{e.key.id}'
+            yield json.dumps(e) + "\n"
+
+    return Response(stream_with_context(generate()), mimetype="application/x-ndjson")
+
+
 @bp.route('/<id>', methods=['GET', 'PUT', 'DELETE', 'PATCH'])
 def employees_get_put_delete(id):
     if "application/json" not in request.accept_mimetypes:
         return {"Error": "This endpoint only supports the return of JSON objects"}, 406
 
-    employee_key = client.key(constants.employees, int(id))
-    employee = client.get(key=employee_key)
+    # only GETs are served from the entity cache: an employee that is written back must be the committed one,
+    # not a snapshot another instance may have changed since (e.g. before they were hired there)
+    loader = EntityLoader.current()
+    with storage.uncached() if request.method != 'GET' else nullcontext():
+        employee = loader.get(employee_repo, int(id))
 
     existence_error = ContentValidation.validate_entity_exists(entity_type=constants.employees, entity=employee)
     if existence_error:
@@ -89,28 +169,34 @@ def employees_get_put_delete(id):
 
     # View one specific employee
     if request.method == 'GET':
+        if ETag.not_modified(request, employee):
+            return '', 304, ETag.header(employee)
 
+        headers = ETag.header(employee)
+        ETag.strip(employee)
         employee["id"] = employee.id
         employee["self"] = f'{request.host_url}employees/{employee.id}'
-        return employee, 200
+        return employee, 200, headers
 
     # Delete an employee
     elif request.method == 'DELETE':
 
         # if unemployed, delete employee
         if employee["workplace"] is None:
-            client.delete(employee)
+            employee_repo.delete(employee.key.id)
 
         # update the restaurant they work at
         else:
             restaurant_id = employee["workplace"]["id"]
-            restaurant_key = client.key(constants.restaurants, int(restaurant_id))
-            restaurant = client.get(key=restaurant_key)
-
-            employee, restaurant = EntityProcessing.remove_employee_from_restaurant(employee, restaurant)
 
-            client.delete(employee)
-            client.put(restaurant)
+            with storage.transaction():
+                restaurant = loader.get(restaurant_repo, int(restaurant_id))
+                if restaurant is not None:
+                    employee, restaurant = EntityProcessing.remove_employee_from_restaurant(employee, restaurant)
+                    restaurant_repo.put(restaurant)
+                employee_repo.delete(employee.key.id)
+        loader.forget(employee_repo, employee.key.id)
+        employees_counter.increment(-1)
         return '', 204
 
     # Update all attributes of an employee
@@ -122,11 +208,16 @@ def employees_get_put_delete(id):
         if content_error:
             return content_error
 
-        # update
-        employee = EntityProcessing.update_entity_all(content, constants.employees, employee)
+        # update; with If-Match the employee is re-read and written in one transaction so no other write slips in
+        with storage.transaction() if request.if_match else nullcontext():
+            if request.if_match:
+                employee = employee_repo.get(employee.key.id)
+                if ETag.precondition_failed(request, employee):
+                    return {"Error": "The employee has been modified since it was retrieved"}, 412
+            employee = EntityProcessing.update_entity_all(content, constants.employees, employee)
 
-        client.put(employee)
-        return '', 204
+            employee_repo.put(employee)
+        return '', 204, ETag.header(employee)
 
     # Update some attributes of an employee
     elif request.method == 'PATCH':
@@ -137,11 +228,44 @@ def employees_get_put_delete(id):
         if content_error:
             return content_error
 
-        # update
-        employee = EntityProcessing.update_entity_some(content, employee)
+        # update; with If-Match the employee is re-read and written in one transaction so no other write slips in
+        with storage.transaction() if request.if_match else nullcontext():
+            if request.if_match:
+                employee = employee_repo.get(employee.key.id)
+                if ETag.precondition_failed(request, employee):
+                    return {"Error": "The employee has been modified since it was retrieved"}, 412
+            employee = EntityProcessing.update_entity_some(content, employee)
 
-        client.put(employee)
-        return employee, 204
+            employee_repo.put(employee)
+        return employee, 204, ETag.header(employee)
     else:
         return 'Method not recognized'
 
+
+def migrate_wages(progress=None):
+    """
+    One-off migration: rewrites the wages stored as integers (by PUT /employees/<id> before it converted them) as
+    floats. Datastore orders integers and floats as separate types, so the wage range filters and the wage sort
+    order leave out or misplace an employee whose wage is an integer.
+    :param progress: optional callable receiving the number of employees migrated so far
+    :return: number of employees migrated
+    """
+    migrated = 0
+    for batch in chunked(employee_repo.iterate()):
+        legacy_employees = [e for e in batch if isinstance(e.get("wage"), int) and not isinstance(e["wage"], bool)]
+        if not legacy_employees:
+            continue
+        for employee in legacy_employees:
+            employee["wage"] = float(employee["wage"])
+        employee_repo.put_multi(legacy_employees)
+        migrated += len(legacy_employees)
+        if progress:
+            progress(migrated)
+    return migrated
+
+
+if __name__ == '__main__':
+    # python employee.py migrate
+    import sys
+    if sys.argv[1:] == ['migrate']:
+        print(f'Migrated {migrate_wages()} employees')
@@ -0,0 +1,246 @@
+from contextlib import contextmanager
+from google.cloud import datastore
+from cache import LRUCache
+import copy
+import pickle
+import threading
+import constants
+
+
+def _copy_entity(entity):
+    duplicate = datastore.Entity(key=entity.key, exclude_from_indexes=tuple(entity.exclude_from_indexes))
+    duplicate.update(copy.deepcopy(dict(entity)))
+    return duplicate
+
+
+class LocalEntityCache:
+    """
+    In-process LRU/TTL store of entity snapshots keyed by (kind, id).
+    """
+
+    # invalidations bump one of these generation counters so a read that raced with a write doesn't re-cache
+    # the value it read before the write
+    STRIPES = 256
+
+    def __init__(self, max_size=constants.ENTITY_CACHE_SIZE, ttl=constants.ENTITY_CACHE_TTL):
+        self._cache = LRUCache(max_size, ttl=ttl)
+        self._generations = [0] * self.STRIPES
+        self._lock = threading.Lock()
+
+    def generation(self, cache_key):
+        return self._generations[hash(cache_key) % self.STRIPES]
+
+    def get(self, cache_key):
+        entity = self._cache.get(cache_key)
+        return _copy_entity(entity) if entity is not None else None
+
+    def set(self, cache_key, entity, generation):
+        snapshot = _copy_entity(entity)
+        # the check and the store happen under the lock invalidate() holds, so no invalidation can fall between
+        with self._lock:
+            if self.generation(cache_key) != generation:
+                return
+            self._cache.set(cache_key, snapshot)
+
+    def invalidate(self, cache_key):
+        with self._lock:
+            self._generations[hash(cache_key) % self.STRIPES] += 1
+            self._cache.delete(cache_key)
+
+    def clear(self):
+        self._cache.clear()
+
+    def stats(self):
+        return self._cache.stats()
+
+
+class RedisEntityCache:
+    """
+    Entity snapshots kept in Redis, shared by every worker so an invalidation made by one is seen by all.
+    Needs the optional `redis` package.
+    """
+
+    # store the snapshot only if no invalidation happened since the read, in one round trip, atomically
+    SET_SCRIPT = """
+local generation = redis.call('GET', KEYS[2]) or '0'
+if generation ~= ARGV[1] then
+    return 0
+end
+redis.call('SET', KEYS[1], ARGV[2], 'EX', ARGV[3])
+return 1
+"""
+
+    def __init__(self, url=constants.ENTITY_CACHE_REDIS_URL, ttl=constants.ENTITY_CACHE_TTL, prefix="entity:"):
+        try:
+            import redis
+        except ImportError:
+            raise RuntimeError("ENTITY_CACHE_REDIS_URL is set but the redis package is not installed")
+        self._redis = redis.Redis.from_url(url)
+        self._set = self._redis.register_script(self.SET_SCRIPT)
+        self.ttl = ttl
+        self.prefix = prefix
+        self.hits = 0
+        self.misses = 0
+
+    def _name(self, cache_key):
+        kind, id_or_name = cache_key
+        return f'{self.prefix}{kind}:{id_or_name}'
+
+    def _generation_name(self, cache_key):
+        kind, id_or_name = cache_key
+        return f'{self.prefix}generation:{kind}:{id_or_name}'
+
+    def generation(self, cache_key):
+        return (self._redis.get(self._generation_name(cache_key)) or b'0').decode()
+
+    def get(self, cache_key):
+        data = self._redis.get(self._name(cache_key))
+        if data is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        return pickle.loads(data)
+
+    def set(self, cache_key, entity, generation):
+        self._set(keys=[self._name(cache_key), self._generation_name(cache_key)],
+                  args=[generation, pickle.dumps(entity), self.ttl])
+
+    def invalidate(self, cache_key):
+        # the generation only has to outlive a read racing with this write; an expired one reads as "0" and
+        # still differs from the generation a racing read saw
+        pipeline = self._redis.pipeline()
+        pipeline.incr(self._generation_name(cache_key))
+        pipeline.expire(self._generation_name(cache_key), self.ttl)
+        pipeline.delete(self._name(cache_key))
+        pipeline.execute()
+
+    def clear(self):
+        for name in self._redis.scan_iter(f'{self.prefix}*'):
+            self._redis.delete(name)
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": 0,
+            "expirations": 0,
+            "hit_ratio": self.hits / lookups if lookups else 0.0
+        }
+
+
+class CachingBackend:
+    """
+    Read-through cache in front of a storage backend. Lookups by key of the cached kinds are served from the
+    cache; every put and delete going through the backend invalidates the written keys, so all write paths
+    (including hire/fire and cascades) keep it coherent. Reads inside a transaction or an uncached() block
+    always go to the backend.
+
+    With the local store, another instance's writes are only seen once the snapshot expires, so the cache is
+    for serving reads: a read that is modified and written back must come from the backend.
+    """
+
+    def __init__(self, backend, store, kinds=constants.ENTITY_CACHE_KINDS):
+        self.backend = backend
+        self.store = store
+        self.kinds = set(kinds)
+        self._local = threading.local()
+
+    def __getattr__(self, name):
+        return getattr(self.backend, name)
+
+    def _cached(self, key):
+        return key.kind in self.kinds and not key.is_partial
+
+    def get_multi(self, keys):
+        if getattr(self._local, "in_transaction", False) or getattr(self._local, "uncached", False):
+            return self.backend.get_multi(keys)
+
+        found = []
+        missing = []
+        for key in keys:
+            if not self._cached(key):
+                missing.append(key)
+                continue
+            entity = self.store.get((key.kind, key.id_or_name))
+            if entity is None:
+                missing.append(key)
+            else:
+                found.append(entity)
+
+        if missing:
+            generations = {key: self.store.generation((key.kind, key.id_or_name)) for key in missing}
+            for entity in self.backend.get_multi(missing):
+                if self._cached(entity.key):
+                    cache_key = (entity.key.kind, entity.key.id_or_name)
+                    self.store.set(cache_key, entity, generations[entity.key])
+                found.append(entity)
+        return found
+
+    def _invalidate(self, keys):
+        keys = [key for key in keys if self._cached(key)]
+        for key in keys:
+            self.store.invalidate((key.kind, key.id_or_name))
+        # writes inside a transaction only land on commit: invalidate again once it is over
+        pending = getattr(self._local, "pending", None)
+        if pending is not None:
+            pending.extend(keys)
+
+    def put_multi(self, entities):
+        self._invalidate([entity.key for entity in entities])
+        self.backend.put_multi(entities)
+        self._invalidate([entity.key for entity in entities])
+
+    def delete_multi(self, keys):
+        self._invalidate(keys)
+        self.backend.delete_multi(keys)
+        self._invalidate(keys)
+
+    @contextmanager
+    def uncached(self):
+        """
+        Sends the lookups made in the block (on this thread) to the backend
+        """
+        previous = getattr(self._local, "uncached", False)
+        self._local.uncached = True
+        try:
+            yield
+        finally:
+            self._local.uncached = previous
+
+    @contextmanager
+    def transaction(self):
+        # a nested block simply joins the transaction already in progress
+        if getattr(self._local, "in_transaction", False):
+            yield None
+            return
+
+        self._local.in_transaction = True
+        self._local.pending = []
+        try:
+            with self.backend.transaction() as transaction:
+                yield transaction
+        finally:
+            pending = self._local.pending
+            self._local.in_transaction = False
+            self._local.pending = None
+            for key in pending:
+                self.store.invalidate((key.kind, key.id_or_name))
+
+    def run_query(self, *args, **kwargs):
+        return self.backend.run_query(*args, **kwargs)
+
+    def stats(self):
+        return self.store.stats()
+
+
+def with_entity_cache(backend):
+    """
+    :param backend: storage backend
+    :return: the backend wrapped in the entity cache configured in constants, or unchanged if it is disabled
+    """
+    if constants.ENTITY_CACHE_REDIS_URL:
+        return CachingBackend(backend, RedisEntityCache())
+    if constants.ENTITY_CACHE_SIZE > 0:
+        return CachingBackend(backend, LocalEntityCache())
+    return backend
@@ -1,7 +1,8 @@
 from flask import jsonify
-from six.moves.urllib.request import urlopen
-from jose import jwt
-import json
+from jwks import key_store, JWKSError
+from cache import LRUCache
+from metrics import timed, jwt_verify_latency, register_stats
+import hashlib
 import constants
 
 
@@ -13,6 +14,9 @@ class AuthError(Exception):
 
 class JWTVerification:
 
+    # verified payloads keyed by the SHA-256 of the token, each entry expires with the token's "exp"
+    token_cache = LRUCache(constants.TOKEN_CACHE_SIZE)
+
     @staticmethod
     def authorize_protected_resource(restaurant, payload):
         if restaurant['owner'] != payload['sub']:
@@ -20,6 +24,7 @@ class JWTVerification:
         return
 
     @staticmethod
+    @timed(jwt_verify_latency, "jwt")
     def verify_jwt(request):
         if 'Authorization' in request.headers:
             auth_header = request.headers['Authorization'].split()
@@ -27,8 +32,14 @@ class JWTVerification:
         else:
             raise AuthError({"Error": "Missing token"}, 401)
 
-        jsonurl = urlopen("https://" + constants.DOMAIN + "/.well-known/jwks.json")
-        jwks = json.loads(jsonurl.read())
+        token_digest = hashlib.sha256(token.encode()).hexdigest()
+        payload = JWTVerification.token_cache.get(token_digest)
+        if payload is not None:
+            return payload
+
+        # imported on the first verification rather than at startup, to keep it off the cold start
+        from jose import jwt
+
         try:
             unverified_header = jwt.get_unverified_header(token)
         except jwt.JWTError:
@@ -41,16 +52,12 @@ class JWTVerification:
                              "description":
                                  "Invalid header. "
                                  "Use an RS256 signed JWT Access Token"}, 401)
-        rsa_key = {}
-        for key in jwks["keys"]:
-            if key["kid"] == unverified_header["kid"]:
-                rsa_key = {
-                    "kty": key["kty"],
-                    "kid": key["kid"],
-                    "use": key["use"],
-                    "n": key["n"],
-                    "e": key["e"]
-                }
+        try:
+            rsa_key = key_store.get_key(unverified_header.get("kid"))
+        except JWKSError:
+            raise AuthError({"code": "jwks_unavailable",
+                             "description":
+                                 "Unable to load the signing keys"}, 503)
         if rsa_key:
             try:
                 payload = jwt.decode(
@@ -74,12 +81,21 @@ class JWTVerification:
                                      "Unable to parse authentication"
                                      " token."}, 401)
 
+            if "exp" in payload:
+                JWTVerification.token_cache.set(token_digest, payload, expires_at=payload["exp"])
             return payload
         else:
             raise AuthError({"code": "no_rsa_key",
                              "description":
                                  "No RSA key in JWKS"}, 401)
 
+    @staticmethod
+    def token_cache_stats():
+        """
+        :return: hit/miss counters of the verified token cache
+        """
+        return JWTVerification.token_cache.stats()
+
     # Decode the JWT supplied in the Authorization header
     @staticmethod
     def decode_jwt(request):
@@ -87,6 +103,9 @@ class JWTVerification:
         return payload
 
 
+register_stats("token_cache", JWTVerification.token_cache_stats)
+
+
 class EntityProcessing:
 
     @staticmethod
@@ -102,6 +121,9 @@ class EntityProcessing:
         if entity_type == "employees":
             if "workplace" in entity:
                 entity.update(content)
+                # stored as a float like below: Datastore sorts integers and floats apart, so an int wage would
+                # fall outside the wage range filters
+                entity["wage"] = float(content["wage"])
             else:
                 entity.update({
                     "name": content["name"],
@@ -111,8 +133,8 @@ class EntityProcessing:
         # restaurants
         elif entity_type == "restaurants":
             entity.update(content)
-            if "employees" not in entity:
-                entity['employees'] = []
+            if "employee_count" not in entity:
+                entity['employee_count'] = 0
         return entity
 
     @staticmethod
@@ -124,12 +146,17 @@ class EntityProcessing:
         :return:
         """
         entity.update(content)
+        # stored as a float like update_entity_all does: Datastore sorts integers and floats apart, so an int
+        # wage would fall outside the wage range filters
+        if "wage" in content:
+            entity["wage"] = float(content["wage"])
         return entity
 
     @staticmethod
     def link_restaurant_and_employee(restaurant, employee, request):
         """
-        makes a logical connection between restaurant and employee (aka, a restaurant hires this employee)
+        makes a logical connection between restaurant and employee (aka, a restaurant hires this employee).
+        The employee's workplace is the record of membership; the restaurant only keeps a head count.
         :param restaurant: hiring restaurant
         :param employee: new employee
         :param request: flask request
@@ -140,11 +167,7 @@ class EntityProcessing:
             "name": restaurant['name'],
             "self": f'{request.host_url}restaurants/{restaurant.id}'
         }
-        restaurant['employees'].append({
-            "id": employee.id,
-            "name": employee["name"],
-            "self": f'{request.host_url}employees/{employee.id}'
-        })
+        restaurant['employee_count'] = restaurant.get('employee_count', 0) + 1
         return restaurant, employee
 
     @staticmethod
@@ -153,15 +176,12 @@ class EntityProcessing:
 
         :param employee: employee entity
         :param restaurant: restaurant entity
-        :return:
+        :return: updated employee and restaurant
         """
-        index_counter = 0
-        for employee_iter in restaurant["employees"]:
-            if int(employee_iter["id"]) == int(employee.id):
-                restaurant["employees"].pop(index_counter)
-                employee["workplace"] = None
-                return employee, restaurant
-            index_counter += 1
+        if ContentValidation.works_at(employee, restaurant):
+            employee["workplace"] = None
+            restaurant["employee_count"] = max(restaurant.get("employee_count", 0) - 1, 0)
+        return employee, restaurant
 
 
 class ContentValidation:
@@ -186,12 +206,19 @@ class ContentValidation:
         :param restaurant:
         :return: if content is valid, returns nothing. if not, returns error message and code.
         """
-        if restaurant is None or employee is None:
+        if restaurant is None or employee is None or not ContentValidation.works_at(employee, restaurant):
             return {"Error": "No employee with this employee_id works at the restaurant with this restaurant_id"}, 404
-        for employee_iter in restaurant["employees"]:
-            if int(employee_iter["id"]) == int(employee.id):
-                return
-        return {"Error": "No employee with this employee_id works at the restaurant with this restaurant_id"}, 404
+        return
+
+    @staticmethod
+    def works_at(employee, restaurant):
+        """
+        :param employee: employee entity
+        :param restaurant: restaurant entity
+        :return: True if the employee's workplace is the restaurant
+        """
+        workplace = employee.get("workplace")
+        return workplace is not None and int(workplace["id"]) == int(restaurant.id)
 
     @staticmethod
     def validation_employee_hire(employee, restaurant):
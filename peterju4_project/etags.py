@@ -0,0 +1,87 @@
+import hashlib
+import json
+
+
+class ETag:
+    """
+    Content-hash ETags. The hash is computed once when an entity is written and stored on it as "etag", so a
+    conditional GET can be answered without serializing the entity.
+    """
+
+    # content codings encoded() may append to a tag
+    ENCODINGS = ("gzip", "br")
+
+    @staticmethod
+    def compute(entity):
+        """
+        :param entity: restaurant or employee entity
+        :return: hash of the entity's stored properties
+        """
+        content = {prop: value for prop, value in entity.items() if prop != "etag"}
+        return hashlib.sha1(json.dumps(content, sort_keys=True, default=str).encode()).hexdigest()
+
+    @staticmethod
+    def stamp(entity):
+        """
+        Stores the content hash on the entity; called by the repository on every write
+        """
+        entity["etag"] = ETag.compute(entity)
+        # never filtered on, so don't pay for an index write
+        entity.exclude_from_indexes.add("etag")
+        return entity
+
+    @staticmethod
+    def strip(entity):
+        """
+        Drops the stored hash from an entity about to be rendered: it is bookkeeping, served only as the ETag
+        header. Take the header first, as ETag.of recomputes the hash when it is missing.
+        """
+        entity.pop("etag", None)
+        return entity
+
+    @staticmethod
+    def of(entity):
+        """
+        :return: the entity's ETag (computed on the fly for entities written before ETags existed)
+        """
+        return entity.get("etag") or ETag.compute(entity)
+
+    @staticmethod
+    def header(entity):
+        """
+        :return: headers carrying the entity's ETag
+        """
+        return {"ETag": f'"{ETag.of(entity)}"'}
+
+    @staticmethod
+    def encoded(header, encoding):
+        """
+        :param header: ETag header of a response, e.g. '"<hash>"'
+        :param encoding: content coding applied to the response body, e.g. "gzip"
+        :return: the strong ETag of the encoded representation, e.g. '"<hash>-gzip"'
+        """
+        return f'{header[:-1]}-{encoding}"'
+
+    @staticmethod
+    def _names(etags, etag, include_weak):
+        # a representation compressed by Compression carries the entity's ETag with its coding appended
+        if etags.star_tag:
+            return True
+        accepted = {etag} | {f'{etag}-{encoding}' for encoding in ETag.ENCODINGS}
+        return not accepted.isdisjoint(etags.as_set(include_weak=include_weak))
+
+    @staticmethod
+    def not_modified(request, entity):
+        """
+        :return: True if the request's If-None-Match already names the entity's current ETag
+        """
+        return entity is not None and ETag._names(request.if_none_match, ETag.of(entity), include_weak=True)
+
+    @staticmethod
+    def precondition_failed(request, entity):
+        """
+        :return: True if the request carries an If-Match the entity's current ETag doesn't satisfy
+        """
+        if not request.if_match:
+            return False
+        return entity is None or not ETag._names(request.if_match, ETag.of(entity), include_weak=False)
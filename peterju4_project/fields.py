@@ -0,0 +1,79 @@
+import constants
+
+
+# properties a client may ask for with ?fields=, besides the computed id and self
+PROPERTIES = {
+    constants.restaurants: ("name", "cost", "cuisine", "owner", "employee_count"),
+    constants.employees: ("name", "wage", "position", "workplace")
+}
+
+# single properties served from their built-in index by a projection query; workplace is an embedded entity, and
+# employee_count is missing on restaurants that predate it
+PROJECTABLE = {
+    constants.restaurants: ("name", "cost", "cuisine", "owner"),
+    constants.employees: ("name", "wage", "position")
+}
+
+
+class Fieldsets:
+    """
+    Sparse fieldsets for the list endpoints: ?fields=name,id returns only those columns.
+    """
+
+    @staticmethod
+    def parse(request, kind):
+        """
+        :param request: flask request
+        :param kind: "restaurants" or "employees" (uses constants.x)
+        :return: requested fields in order, or None when the parameter is absent
+        """
+        if 'fields' not in request.args:
+            return None
+        fields = []
+        for field in request.args['fields'].split(','):
+            field = field.strip()
+            if field not in PROPERTIES[kind] and field not in ("id", "self"):
+                raise ValueError(f"'{field}' is not a field of {kind}")
+            if field not in fields:
+                fields.append(field)
+        return fields
+
+    @staticmethod
+    def query_args(fields, kind, query_args):
+        """
+        Narrows the query to the requested columns where Datastore can do it without a composite index: id/self
+        alone need a keys-only query, and one indexed property with no filters needs a projection on it (rows
+        then come in order of that property).
+        :param fields: fields from parse()
+        :param kind: "restaurants" or "employees" (uses constants.x)
+        :param query_args: query arguments of the list endpoint
+        :return: query arguments to add
+        """
+        if fields is None:
+            return {}
+        stored = [field for field in fields if field not in ("id", "self")]
+        if not stored:
+            return {"keys_only": True}
+        if len(stored) == 1 and stored[0] in PROJECTABLE[kind] and not query_args.get("filters"):
+            return {"projection": stored, "order": stored}
+        return {}
+
+    @staticmethod
+    def render(entity, fields, self_url):
+        """
+        :param entity: listed entity
+        :param fields: fields from parse()
+        :param self_url: url of the collection, ending in "/"
+        :return: dict carrying only the requested fields
+        """
+        row = {}
+        # Key.id rebuilds the key's path on every access, so look it up once
+        id = entity.key.id if "id" in fields or "self" in fields else None
+        for field in fields:
+            if field == "id":
+                row["id"] = id
+            elif field == "self":
+                row["self"] = f'{self_url}{id}'
+            elif field in entity:
+                row[field] = entity[field]
+        return row
@@ -0,0 +1,76 @@
+import constants
+
+
+COSTS = ["$", "$$", "$$$", "$$$$"]
+
+
+class ListFilters:
+    """
+    Translates the query parameters of the list endpoints into storage filters, so the filtering happens in the
+    Datastore query instead of on the client. The composite indexes these combinations need are in index.yaml.
+    """
+
+    @staticmethod
+    def restaurants(request, payload):
+        """
+        ?owner=me (or an owner's sub), ?cuisine=, ?cost=
+        :param request: flask request
+        :param payload: verified JWT payload of the caller
+        :return: query arguments for Repository.query
+        """
+        filters = []
+        owner = request.args.get('owner')
+        if owner:
+            filters.append(("owner", "=", payload['sub'] if owner == 'me' else owner))
+        if 'cuisine' in request.args:
+            filters.append(("cuisine", "=", request.args['cuisine']))
+        if 'cost' in request.args:
+            if request.args['cost'] not in COSTS:
+                raise ValueError("The ‘cost’ value must equal $, $$, $$$, or $$$$")
+            filters.append(("cost", "=", request.args['cost']))
+        return {"filters": filters}
+
+    @staticmethod
+    def employees(request):
+        """
+        ?position=, ?min_wage=, ?max_wage=, ?unemployed=true. Wages are compared as floats: employees whose wage
+        was stored as an integer are only matched once `python employee.py migrate` has rewritten it.
+        :param request: flask request
+        :return: query arguments for Repository.query
+        """
+        filters = []
+        if 'position' in request.args:
+            filters.append(("position", "=", request.args['position']))
+        if request.args.get('unemployed', 'false').lower() == 'true':
+            filters.append(("workplace", "=", None))
+
+        wage_range = False
+        for arg, op in (('min_wage', '>='), ('max_wage', '<=')):
+            if arg in request.args:
+                try:
+                    wage = float(request.args[arg])
+                except ValueError:
+                    raise ValueError(f"The '{arg}' value must be a number")
+                filters.append(("wage", op, wage))
+                wage_range = True
+
+        # Datastore wants the inequality property to lead the sort order
+        return {"filters": filters, "order": ["wage"] if wage_range else None}
+
+    @staticmethod
+    def count(repo, query_args):
+        """
+        A filtered list has no counter to read, so its count walks the matching keys: one page of keys per
+        MAX_BATCH_SIZE matches on every request. The walk stops past FILTERED_COUNT_LIMIT matches, and callers
+        paging through a large filtered list should pass ?count=false.
+        :param repo: storage.Repository of the listed kind
+        :param query_args: query arguments from restaurants() or employees()
+        :return: the "count" (and "count_capped" when the walk stopped early) of the list response, or None when
+                 unfiltered (use the kind's counter)
+        """
+        if not query_args["filters"]:
+            return None
+        count = repo.count(filters=query_args["filters"], limit=constants.FILTERED_COUNT_LIMIT + 1)
+        if count > constants.FILTERED_COUNT_LIMIT:
+            return {"count": constants.FILTERED_COUNT_LIMIT, "count_capped": True}
+        return {"count": count}
@@ -0,0 +1,200 @@
+from concurrent.futures import ThreadPoolExecutor
+from flask import Blueprint, request
+import storage
+import json
+import logging
+import threading
+import time
+import uuid
+import constants
+
+
+logger = logging.getLogger(__name__)
+
+bp = Blueprint('job', __name__, url_prefix='/jobs')
+
+job_repo = storage.repository(constants.jobs)
+
+ACTIVE_STATES = ("queued", "running")
+
+
+class JobRunner:
+    """
+    Runs long operations (e.g. wiping a kind, or deleting a restaurant and releasing its staff) on a thread pool.
+
+    Every job is recorded as an entity of the jobs kind, so its status can be polled from any instance. Running
+    jobs refresh their record's "updated" time; a queued or running job whose record has gone stale was cut
+    short by a crash or a shutdown, and resume() runs it again. Job handlers are written to be idempotent, so
+    running one twice only finishes the work.
+    """
+
+    def __init__(self, workers=constants.JOB_WORKERS):
+        self.workers = workers
+        self._handlers = {}
+        self._executor = None
+        # job id -> record of the jobs running in this process
+        self._running = {}
+        self._lock = threading.Lock()
+        self._heartbeat = None
+
+    def register(self, name, handler):
+        """
+        :param name: name of the operation, e.g. "delete-all-restaurants"
+        :param handler: callable(progress, **params); progress(processed) reports how far it got, and its return
+                        value is stored as the job's result
+        """
+        self._handlers[name] = handler
+
+    def submit(self, name, **params):
+        """
+        Queues a job. If the same operation with the same parameters is already queued or running, that job is
+        returned instead of starting a second one.
+        :param name: name of a registered operation
+        :param params: keyword arguments of the handler; must be JSON serializable
+        :return: the job's status
+        """
+        dedupe_key = f'{name}:{json.dumps(params, sort_keys=True)}'
+        with self._lock:
+            for state in ACTIVE_STATES:
+                existing, _ = job_repo.query(filters=[("dedupe_key", "=", dedupe_key), ("state", "=", state)], limit=1)
+                if existing:
+                    return self.describe(existing[0])
+
+            now = time.time()
+            job = job_repo.new(uuid.uuid4().hex, exclude_from_indexes=("params", "result", "error"))
+            job.update({
+                "name": name,
+                "dedupe_key": dedupe_key,
+                "params": json.dumps(params),
+                "state": "queued",
+                "processed": 0,
+                "result": None,
+                "error": None,
+                "created": now,
+                "updated": now,
+                "finished": None
+            })
+            job_repo.put(job)
+        self._start(job)
+        return self.describe(job)
+
+    def get(self, job_id):
+        """
+        :return: the job's status, or None if there is no such job
+        """
+        job = job_repo.get(job_id)
+        return self.describe(job) if job is not None else None
+
+    @staticmethod
+    def describe(job):
+        return {
+            "id": job.key.name,
+            "name": job["name"],
+            "state": job["state"],
+            "processed": job["processed"],
+            "result": job["result"],
+            "error": job["error"],
+            "created": job["created"],
+            "finished": job["finished"]
+        }
+
+    def resume(self):
+        """
+        Claims the queued/running jobs whose records went stale and runs them again
+        :return: number of jobs resumed
+        """
+        resumed = 0
+        cutoff = time.time() - constants.JOB_STALE_AFTER
+        for state in ACTIVE_STATES:
+            for stale in list(job_repo.iterate(filters=[("state", "=", state), ("updated", "<", cutoff)])):
+                # claim it, so two instances starting together don't both pick it up
+                with storage.transaction():
+                    job = job_repo.get(stale.key.name)
+                    if job is None or job["state"] not in ACTIVE_STATES or job["updated"] >= cutoff:
+                        continue
+                    job["updated"] = time.time()
+                    job_repo.put(job)
+                logger.info("Resuming job %s (%s)", job.key.name, job["name"])
+                self._start(job)
+                resumed += 1
+        return resumed
+
+    def start_resume(self):
+        """
+        Runs resume() on a background thread, so starting an instance doesn't wait on the query
+        """
+        threading.Thread(target=self._resume_safely, name="job-resume", daemon=True).start()
+
+    def _resume_safely(self):
+        try:
+            self.resume()
+        except Exception:
+            logger.exception("Resuming jobs failed")
+
+    def _start(self, job):
+        with self._lock:
+            if self._executor is None:
+                self._executor = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix="job")
+            if self._heartbeat is None:
+                self._heartbeat = threading.Thread(target=self._heartbeat_loop, name="job-heartbeat", daemon=True)
+                self._heartbeat.start()
+            self._running[job.key.name] = job
+        self._executor.submit(self._run, job)
+
+    def _run(self, job):
+        def progress(processed):
+            job["processed"] = processed
+
+        handler = self._handlers.get(job["name"])
+        job["state"] = "running"
+        try:
+            self._save(job)
+            if handler is None:
+                raise ValueError(f'Unknown job {job["name"]}')
+            job["result"] = handler(progress, **json.loads(job["params"]))
+            job["state"] = "done"
+        except Exception as ex:
+            logger.exception("Job %s failed", job["name"])
+            job["error"] = str(ex)
+            job["state"] = "failed"
+        job["finished"] = time.time()
+        with self._lock:
+            self._running.pop(job.key.name, None)
+        try:
+            self._save(job)
+        except Exception:
+            # the record keeps its last state and goes stale, so resume() runs the job again
+            logger.exception("Saving job %s failed", job.key.name)
+
+    @staticmethod
+    def _save(job):
+        job["updated"] = time.time()
+        job_repo.put(job)
+
+    def _heartbeat_loop(self):
+        # keeps the records of running jobs fresh (and their progress visible) so resume() leaves them alone
+        while True:
+            time.sleep(constants.JOB_HEARTBEAT)
+            with self._lock:
+                running = list(self._running.values())
+            for job in running:
+                try:
+                    self._save(job)
+                except Exception:
+                    logger.exception("Job heartbeat failed for %s", job.key.name)
+
+
+runner = JobRunner()
+
+
+@bp.route('/<job_id>', methods=['GET'])
+def jobs_get(job_id):
+    if "application/json" not in request.accept_mimetypes:
+        return {"Error": "This endpoint only supports the return of JSON objects"}, 406
+
+    job = runner.get(job_id)
+    if job is None:
+        return {"Error": "No job with this job_id exists"}, 404
+
+    job["self"] = f'{request.host_url}jobs/{job_id}'
+    return job, 200
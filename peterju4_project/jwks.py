@@ -0,0 +1,158 @@
+from six.moves.urllib.request import urlopen
+import json
+import logging
+import threading
+import time
+from metrics import timed, jwks_fetch_latency
+import constants
+
+
+logger = logging.getLogger(__name__)
+
+
+class JWKSError(Exception):
+    pass
+
+
+class JWKSKeyStore:
+    """
+    Process-wide store of the identity provider's signing keys, indexed by kid.
+
+    Keys are loaded once and kept for `ttl` seconds. A daemon thread refreshes them before they go stale, and
+    a token signed with an unknown kid triggers an immediate refetch (at most once per `min_refetch_interval`
+    seconds) so key rotation is picked up without waiting for the TTL. If a refresh fails, the previous keys
+    keep being served.
+    """
+
+    def __init__(self, url=None, path=None, ttl=constants.JWKS_TTL,
+                 min_refetch_interval=constants.JWKS_MIN_REFETCH_INTERVAL, timeout=constants.JWKS_FETCH_TIMEOUT):
+        """
+        :param url: JWKS endpoint of the identity provider
+        :param path: local JWKS file; when set it is used instead of the url
+        :param ttl: seconds the loaded keys are considered fresh
+        :param min_refetch_interval: minimum seconds between two fetches triggered by unknown kids
+        :param timeout: seconds to wait for the JWKS endpoint
+        """
+        self.url = url
+        self.path = path
+        self.ttl = ttl
+        self.min_refetch_interval = min_refetch_interval
+        self.timeout = timeout
+
+        self._keys = {}
+        self._expires_at = 0.0
+        self._last_fetch = None
+        self._lock = threading.Lock()
+        self._refresher = None
+        self._stop = threading.Event()
+
+    def get_key(self, kid):
+        """
+        Returns the RSA key matching the kid, refetching the key set once if the kid is unknown
+        :param kid: "kid" from the unverified JWT header
+        :return: the key as a dict usable by jose, or None if the identity provider doesn't publish it
+        """
+        if not self._keys:
+            self.refresh()
+            self._start_refresher()
+        elif time.monotonic() >= self._expires_at:
+            self.refresh()
+
+        key = self._keys.get(kid)
+        if key is None and self._may_refetch():
+            self.refresh(force=True)
+            key = self._keys.get(kid)
+        return key
+
+    def refresh(self, force=False):
+        """
+        Reloads the key set. Concurrent callers wait for the one fetch in flight instead of starting their own.
+        :param force: reload even if the current keys are still fresh
+        :return: nothing. raises JWKSError if no keys could be loaded at all.
+        """
+        started = time.monotonic()
+        with self._lock:
+            # another thread refreshed while this one was waiting for the lock
+            if self._last_fetch is not None and self._last_fetch >= started and self._keys:
+                return
+            if not force and self._keys and time.monotonic() < self._expires_at:
+                return
+
+            self._last_fetch = time.monotonic()
+            try:
+                with timed(jwks_fetch_latency, "jwks"):
+                    jwks = self._load()
+                keys = self._index(jwks)
+            except Exception as ex:
+                if not self._keys:
+                    raise JWKSError(f'Unable to load JWKS: {ex}')
+                # keep serving the previous keys, try again after the refetch interval
+                logger.warning("JWKS refresh failed, keeping %d cached keys: %s", len(self._keys), ex)
+                self._expires_at = time.monotonic() + self.min_refetch_interval
+                return
+
+            self._keys = keys
+            self._expires_at = time.monotonic() + self.ttl
+
+    def clear(self):
+        """
+        Drops the cached keys so the next lookup reloads them
+        """
+        with self._lock:
+            self._keys = {}
+            self._expires_at = 0.0
+            self._last_fetch = None
+
+    def stop(self):
+        """
+        Stops the background refresher
+        """
+        self._stop.set()
+
+    def _load(self):
+        if self.path:
+            with open(self.path) as jwks_file:
+                return json.load(jwks_file)
+        response = urlopen(self.url, timeout=self.timeout)
+        return json.loads(response.read())
+
+    @staticmethod
+    def _index(jwks):
+        keys = {}
+        for key in jwks["keys"]:
+            if key.get("kty") != "RSA" or "kid" not in key:
+                continue
+            keys[key["kid"]] = {
+                "kty": key["kty"],
+                "kid": key["kid"],
+                "use": key.get("use", "sig"),
+                "n": key["n"],
+                "e": key["e"]
+            }
+        if not keys:
+            raise JWKSError("No RSA keys in JWKS")
+        return keys
+
+    def _may_refetch(self):
+        return self._last_fetch is None or time.monotonic() - self._last_fetch >= self.min_refetch_interval
+
+    def _start_refresher(self):
+        with self._lock:
+            if self._refresher is not None:
+                return
+            self._refresher = threading.Thread(target=self._refresh_loop, name="jwks-refresher", daemon=True)
+            self._refresher.start()
+
+    def _refresh_loop(self):
+        while not self._stop.is_set():
+            # refresh shortly before the keys go stale so requests never wait on the fetch
+            delay = max(self._expires_at - time.monotonic() - min(60, self.ttl / 10), 1)
+            if self._stop.wait(delay):
+                return
+            try:
+                self.refresh(force=True)
+            except JWKSError as ex:
+                logger.warning("Background JWKS refresh failed: %s", ex)
+
+
+key_store = JWKSKeyStore(url=constants.JWKS_URL, path=constants.JWKS_FILE)
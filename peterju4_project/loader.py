@@ -0,0 +1,64 @@
+from flask import g, has_request_context
+import storage
+
+
+class EntityLoader:
+    """
+    Request-scoped batching loader for lookups by key, in the style of DataLoader. The keys a get_many() asks for
+    are fetched together, in one get_multi across kinds, and every entity fetched is memoized for the rest of the
+    request; handlers forget() the entities they delete.
+
+    Reads that must see the latest committed state, like the re-reads inside an If-Match transaction, go to the
+    repository directly instead.
+    """
+
+    def __init__(self):
+        # (kind, id) -> key still to fetch
+        self._pending = {}
+        # (kind, id) -> entity, or None if it doesn't exist
+        self._loaded = {}
+
+    @staticmethod
+    def current():
+        """
+        :return: the loader of the current request, or a fresh one outside a request
+        """
+        if not has_request_context():
+            return EntityLoader()
+        if "entity_loader" not in g:
+            g.entity_loader = EntityLoader()
+        return g.entity_loader
+
+    def get(self, repo, id):
+        """
+        :param repo: storage.Repository of the entity's kind
+        :param id: id or name of the entity
+        :return: the entity, or None if it doesn't exist
+        """
+        return self.get_many([(repo, id)])[0]
+
+    def get_many(self, lookups):
+        """
+        :param lookups: (repository, id) pairs, of any kinds
+        :return: the entities in the same order, None for those that don't exist
+        """
+        for repo, id in lookups:
+            if (repo.kind, id) not in self._loaded:
+                self._pending[(repo.kind, id)] = repo.key(id)
+        self._flush()
+        return [self._loaded[(repo.kind, id)] for repo, id in lookups]
+
+    def forget(self, repo, id):
+        """
+        Drops a memoized entity, e.g. after deleting it
+        """
+        self._loaded.pop((repo.kind, id), None)
+
+    def _flush(self):
+        if not self._pending:
+            return
+        pending, self._pending = self._pending, {}
+        for lookup in pending:
+            self._loaded[lookup] = None
+        for entity in storage.get_multi(list(pending.values())):
+            self._loaded[(entity.key.kind, entity.key.id_or_name)] = entity
@@ -0,0 +1,383 @@
+"""
+End-to-end load harness built from the Postman collection.
+
+Runs weighted scenarios (create restaurant, create employee, hire, list pages, patch, delete cascade) against the
+app at a configurable concurrency and reports p50/p95/p99 latency and throughput per endpoint.
+
+In-process, against the in-memory storage backend and a local JWT signer:
+    python loadtest.py --duration 30 --concurrency 8
+
+Against a running server (start it with JWKS_FILE pointing at the file written by --jwks-out, and either
+STORAGE_BACKEND=memory or DATASTORE_EMULATOR_HOST set):
+    python loadtest.py --url http://localhost:8080 --jwks-out /tmp/jwks.json --duration 30
+"""
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urlsplit
+import argparse
+import json
+import os
+import random
+import re
+import sys
+import tempfile
+import threading
+import time
+
+
+COLLECTION = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "peterju4_project.postman_collection.json")
+
+DEFAULT_WEIGHTS = {
+    "create_restaurant": 2,
+    "create_employee": 4,
+    "hire": 3,
+    "list_pages": 6,
+    "patch": 3,
+    "delete_cascade": 1
+}
+
+
+class PostmanCollection:
+    """
+    Request templates extracted from the Postman collection, grouped by "METHOD /path/<id>"
+    """
+
+    def __init__(self, path=COLLECTION):
+        with open(path) as collection_file:
+            collection = json.load(collection_file)
+        self.requests = {}
+        self._walk(collection["item"])
+
+    def _walk(self, items):
+        for item in items:
+            if "item" in item:
+                self._walk(item["item"])
+                continue
+            request = item["request"]
+            url = request["url"]["raw"] if isinstance(request["url"], dict) else request["url"]
+            path = re.sub(r"\{\{[^}]+\}\}", "<id>", url.replace("{{app_url}}", "")).split("?")[0]
+            body = None
+            raw = (request.get("body") or {}).get("raw")
+            if raw:
+                try:
+                    body = json.loads(raw)
+                except ValueError:
+                    body = None
+            self.requests.setdefault(f'{request["method"]} {path}', []).append(body)
+
+    def bodies(self, endpoint, validator=None):
+        """
+        :param endpoint: "METHOD /path"
+        :param validator: optional ContentValidation check; bodies it rejects are left out
+        :return: JSON bodies the collection sends to that endpoint
+        """
+        bodies = [body for body in self.requests.get(endpoint, []) if isinstance(body, dict)]
+        if validator:
+            bodies = [body for body in bodies if not validator(body)]
+        return bodies
+
+
+class Recorder:
+    """
+    Collects latency samples per endpoint
+    """
+
+    def __init__(self):
+        self.samples = {}
+        self.errors = {}
+        self._lock = threading.Lock()
+
+    def record(self, endpoint, seconds, status):
+        with self._lock:
+            self.samples.setdefault(endpoint, []).append(seconds)
+            if status >= 500 or status == 0:
+                self.errors[endpoint] = self.errors.get(endpoint, 0) + 1
+
+    @staticmethod
+    def percentile(values, pct):
+        if not values:
+            return 0.0
+        ordered = sorted(values)
+        index = max(int(round(pct / 100 * len(ordered) + 0.5)) - 1, 0)
+        return ordered[min(index, len(ordered) - 1)]
+
+    def report(self, elapsed):
+        """
+        :param elapsed: wall-clock seconds of the measured run
+        :return: per-endpoint statistics, latencies in milliseconds
+        """
+        report = {}
+        for endpoint, values in sorted(self.samples.items()):
+            report[endpoint] = {
+                "requests": len(values),
+                "errors": self.errors.get(endpoint, 0),
+                "throughput": len(values) / elapsed if elapsed else 0.0,
+                "p50": self.percentile(values, 50) * 1000,
+                "p95": self.percentile(values, 95) * 1000,
+                "p99": self.percentile(values, 99) * 1000
+            }
+        return report
+
+
+class FlaskTarget:
+    """
+    Sends requests through the Flask test client, one client per worker thread
+    """
+
+    def __init__(self, app):
+        self.app = app
+        self._local = threading.local()
+
+    def request(self, method, path, token=None, body=None):
+        if not hasattr(self._local, "client"):
+            self._local.client = self.app.test_client()
+        headers = {"Accept": "application/json"}
+        if token:
+            headers["Authorization"] = f'Bearer {token}'
+        response = self._local.client.open(path, method=method, headers=headers, json=body)
+        try:
+            return response.status_code, json.loads(response.get_data() or b"null")
+        except ValueError:
+            return response.status_code, None
+
+
+class HTTPTarget:
+    """
+    Sends requests to a running server, one HTTP session per worker thread
+    """
+
+    def __init__(self, base_url):
+        self.base_url = base_url.rstrip("/")
+        self._local = threading.local()
+
+    def request(self, method, path, token=None, body=None):
+        import requests
+        if not hasattr(self._local, "session"):
+            self._local.session = requests.Session()
+        headers = {"Accept": "application/json"}
+        if token:
+            headers["Authorization"] = f'Bearer {token}'
+        try:
+            response = self._local.session.request(method, self.base_url + path, headers=headers, json=body)
+        except requests.RequestException:
+            return 0, None
+        try:
+            return response.status_code, response.json()
+        except ValueError:
+            return response.status_code, None
+
+
+class LoadTest:
+    """
+    Drives weighted scenarios against a target and records every request
+    """
+
+    def __init__(self, target, signer, collection, owners=5, page_size=5, max_pages=3):
+        from entity_processing import ContentValidation
+        import constants
+
+        self.target = target
+        self.recorder = Recorder()
+        self.tokens = [signer.token(f'load-test|owner-{i}') for i in range(owners)]
+        self.page_size = page_size
+        self.max_pages = max_pages
+
+        self.restaurant_bodies = collection.bodies(
+            "POST /restaurants", lambda b: ContentValidation.validation_all_attributes(b, constants.restaurants))
+        self.employee_bodies = collection.bodies(
+            "POST /employees", lambda b: ContentValidation.validation_all_attributes(b, constants.employees))
+        self.restaurant_patches = collection.bodies(
+            "PATCH /restaurants/<id>", lambda b: ContentValidation.validation_some_attributes(b, constants.restaurants))
+        self.employee_patches = collection.bodies(
+            "PATCH /employees/<id>", lambda b: ContentValidation.validation_some_attributes(b, constants.employees))
+
+        # (restaurant id, owner token) and employee ids created during the run
+        self.restaurants = []
+        self.unemployed = []
+        self.employed = {}
+        self._lock = threading.Lock()
+
+    def call(self, endpoint, method, path, token=None, body=None):
+        started = time.perf_counter()
+        status, data = self.target.request(method, path, token=token, body=body)
+        self.recorder.record(endpoint, time.perf_counter() - started, status)
+        return status, data
+
+    # scenarios ----------------------------------------------------------------------------------------------
+
+    def create_restaurant(self):
+        token = random.choice(self.tokens)
+        status, data = self.call("POST /restaurants", "POST", "/restaurants", token,
+                                 dict(random.choice(self.restaurant_bodies)))
+        if status == 201:
+            with self._lock:
+                self.restaurants.append((data["id"], token))
+
+    def create_employee(self):
+        status, data = self.call("POST /employees", "POST", "/employees", body=dict(random.choice(self.employee_bodies)))
+        if status == 201:
+            with self._lock:
+                self.unemployed.append(data["id"])
+
+    def hire(self):
+        with self._lock:
+            if not self.restaurants or not self.unemployed:
+                return
+            restaurant_id, token = random.choice(self.restaurants)
+            employee_id = self.unemployed.pop(random.randrange(len(self.unemployed)))
+        status, _ = self.call("PUT /restaurants/<id>/employees/<id>", "PUT",
+                              f'/restaurants/{restaurant_id}/employees/{employee_id}', token)
+        with self._lock:
+            if status == 204:
+                self.employed.setdefault(restaurant_id, []).append(employee_id)
+            else:
+                self.unemployed.append(employee_id)
+
+    def list_pages(self):
+        kind = random.choice(("restaurants", "employees"))
+        token = random.choice(self.tokens) if kind == "restaurants" else None
+        path = f'/{kind}?limit={self.page_size}'
+        for _ in range(self.max_pages):
+            status, data = self.call(f'GET /{kind}', "GET", path, token)
+            if status != 200 or not data or not data.get("next"):
+                return
+            next_url = urlsplit(data["next"])
+            path = next_url.path + "?" + next_url.query
+
+    def patch(self):
+        with self._lock:
+            restaurant = random.choice(self.restaurants) if self.restaurants else None
+            employee_id = random.choice(self.unemployed) if self.unemployed else None
+        if restaurant and (employee_id is None or random.random() < 0.5):
+            restaurant_id, token = restaurant
+            self.call("PATCH /restaurants/<id>", "PATCH", f'/restaurants/{restaurant_id}', token,
+                      dict(random.choice(self.restaurant_patches)))
+        elif employee_id:
+            self.call("PATCH /employees/<id>", "PATCH", f'/employees/{employee_id}',
+                      body=dict(random.choice(self.employee_patches)))
+
+    def delete_cascade(self):
+        with self._lock:
+            if not self.restaurants:
+                return
+            restaurant_id, token = self.restaurants.pop(random.randrange(len(self.restaurants)))
+            staff = self.employed.pop(restaurant_id, [])
+        status, _ = self.call("DELETE /restaurants/<id>", "DELETE", f'/restaurants/{restaurant_id}', token)
+        with self._lock:
+            if status == 204:
+                self.unemployed.extend(staff)
+            else:
+                self.restaurants.append((restaurant_id, token))
+                self.employed[restaurant_id] = staff
+
+    # driver -------------------------------------------------------------------------------------------------
+
+    def seed(self, restaurants, employees):
+        for _ in range(restaurants):
+            self.create_restaurant()
+        for _ in range(employees):
+            self.create_employee()
+        self.recorder = Recorder()
+
+    def run(self, weights, duration=None, iterations=None, concurrency=4):
+        """
+        :param weights: scenario name -> relative weight
+        :param duration: seconds to run for
+        :param iterations: total scenarios to run (alternative to duration)
+        :param concurrency: worker threads
+        :return: per-endpoint report and the elapsed time
+        """
+        names = [name for name, weight in weights.items() if weight > 0]
+        scenario_weights = [weights[name] for name in names]
+        deadline = time.perf_counter() + duration if duration else None
+        remaining = [iterations]
+        counter_lock = threading.Lock()
+
+        def worker():
+            while True:
+                if deadline and time.perf_counter() >= deadline:
+                    return
+                if iterations is not None:
+                    with counter_lock:
+                        if remaining[0] <= 0:
+                            return
+                        remaining[0] -= 1
+                getattr(self, random.choices(names, scenario_weights)[0])()
+
+        started = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=concurrency) as pool:
+            for future in [pool.submit(worker) for _ in range(concurrency)]:
+                future.result()
+        elapsed = time.perf_counter() - started
+        return self.recorder.report(elapsed), elapsed
+
+
+def parse_weights(spec):
+    weights = dict(DEFAULT_WEIGHTS)
+    for pair in filter(None, (spec or "").split(",")):
+        name, _, weight = pair.partition("=")
+        if name not in DEFAULT_WEIGHTS:
+            raise SystemExit(f'Unknown scenario: {name} (choose from {", ".join(DEFAULT_WEIGHTS)})')
+        weights[name] = float(weight)
+    return weights
+
+
+def print_report(report, elapsed):
+    print(f'{"endpoint":<40}{"reqs":>8}{"errors":>8}{"req/s":>10}{"p50 ms":>10}{"p95 ms":>10}{"p99 ms":>10}')
+    for endpoint, stats in report.items():
+        print(f'{endpoint:<40}{stats["requests"]:>8}{stats["errors"]:>8}{stats["throughput"]:>10.1f}'
+              f'{stats["p50"]:>10.2f}{stats["p95"]:>10.2f}{stats["p99"]:>10.2f}')
+    total = sum(stats["requests"] for stats in report.values())
+    print(f'{total} requests in {elapsed:.2f}s ({total / elapsed if elapsed else 0:.1f} req/s)')
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Load test the restaurants API with scenarios from the Postman collection")
+    parser.add_argument("--url", help="base url of a running server; default runs in-process with the Flask test client")
+    parser.add_argument("--collection", default=COLLECTION, help="Postman collection to take request bodies from")
+    parser.add_argument("--duration", type=float, help="seconds to run (default 10 unless --iterations is given)")
+    parser.add_argument("--iterations", type=int, help="total number of scenarios to run")
+    parser.add_argument("--concurrency", type=int, default=4)
+    parser.add_argument("--weights", help="scenario weights, e.g. hire=5,delete_cascade=0")
+    parser.add_argument("--owners", type=int, default=5, help="number of distinct restaurant owners (JWT subs)")
+    parser.add_argument("--seed-restaurants", type=int, default=20)
+    parser.add_argument("--seed-employees", type=int, default=100)
+    parser.add_argument("--page-size", type=int, default=5)
+    parser.add_argument("--jwks-out", help="where to write the local signer's JWKS (default: a temp file)")
+    parser.add_argument("--json", help="also write the report as JSON to this file")
+    args = parser.parse_args(argv)
+
+    # constants reads its settings at import, so the environment has to be set before any app module is imported
+    jwks_path = args.jwks_out or os.path.join(tempfile.mkdtemp(), "jwks.json")
+    if not args.url:
+        os.environ["JWKS_FILE"] = jwks_path
+        os.environ.setdefault("STORAGE_BACKEND", "memory")
+        # measure capacity, not the per-subject rate limits
+        os.environ.setdefault("RATE_LIMIT_DEFAULT", "")
+
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+    from local_jwt import LocalJWTSigner
+    signer = LocalJWTSigner()
+    signer.write_jwks(jwks_path)
+
+    if args.url:
+        target = HTTPTarget(args.url)
+    else:
+        from main import app
+        target = FlaskTarget(app)
+
+    load_test = LoadTest(target, signer, PostmanCollection(args.collection), owners=args.owners,
+                         page_size=args.page_size)
+    load_test.seed(args.seed_restaurants, args.seed_employees)
+
+    duration = args.duration if args.duration or args.iterations else 10
+    report, elapsed = load_test.run(parse_weights(args.weights), duration=duration, iterations=args.iterations,
+                                    concurrency=args.concurrency)
+    print_report(report, elapsed)
+    if args.json:
+        with open(args.json, "w") as report_file:
+            json.dump({"elapsed": elapsed, "endpoints": report}, report_file, indent=2)
+    return 1 if any(stats["errors"] for stats in report.values()) else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
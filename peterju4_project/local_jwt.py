@@ -0,0 +1,61 @@
+from jose import jwt
+import base64
+import json
+import time
+import rsa
+import constants
+
+
+class LocalJWTSigner:
+    """
+    Signs RS256 tokens with a locally generated key, for load tests and offline runs. Point the JWKS key store
+    at the file written by write_jwks() (JWKS_FILE) so the app accepts the tokens.
+    """
+
+    def __init__(self, kid="local-signer", bits=2048):
+        """
+        :param kid: key id placed in the JWKS and in the header of every token
+        :param bits: RSA key size
+        """
+        self.kid = kid
+        self.public_key, self.private_key = rsa.newkeys(bits)
+        self._pem = self.private_key.save_pkcs1().decode()
+
+    @staticmethod
+    def _b64_int(value):
+        raw = value.to_bytes((value.bit_length() + 7) // 8, "big")
+        return base64.urlsafe_b64encode(raw).rstrip(b"=").decode()
+
+    def jwks(self):
+        """
+        :return: JWKS document publishing the public key
+        """
+        return {"keys": [{
+            "kty": "RSA",
+            "kid": self.kid,
+            "use": "sig",
+            "alg": "RS256",
+            "n": self._b64_int(self.public_key.n),
+            "e": self._b64_int(self.public_key.e)
+        }]}
+
+    def write_jwks(self, path):
+        with open(path, "w") as jwks_file:
+            json.dump(self.jwks(), jwks_file)
+        return path
+
+    def token(self, sub, ttl=3600):
+        """
+        :param sub: subject (owner) of the token
+        :param ttl: seconds until the token expires
+        :return: signed JWT with the audience and issuer the app expects
+        """
+        now = int(time.time())
+        claims = {
+            "sub": sub,
+            "aud": constants.CLIENT_ID,
+            "iss": "https://" + constants.DOMAIN + "/",
+            "iat": now,
+            "exp": now + ttl
+        }
+        return jwt.encode(claims, self._pem, algorithm="RS256", headers={"kid": self.kid})
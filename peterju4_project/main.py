@@ -1,59 +1,65 @@
-from google.cloud import datastore
-from flask import Flask, request, jsonify, render_template, session, url_for, redirect
+import time
+
+# measured from the first line of main, so the report covers importing the blueprints and their dependencies
+_import_started = time.perf_counter()
+
+from flask import Flask, current_app, jsonify, render_template, session, url_for, redirect
 import restaurant
 import employee
 import user
+from user import ensure_user
+import jobs
 import constants
+from metrics import Metrics, visitors
+from compression import Compression
+from ratelimit import AdmissionControl
+from profiling import Profiler
 from entity_processing import AuthError
 
-from six.moves.urllib.request import urlopen
-from jose import jwt
-
-from os import environ as env
 from urllib.parse import quote_plus, urlencode
-from dotenv import find_dotenv, load_dotenv
 
 import json
-import requests
-
-from authlib.integrations.flask_client import OAuth
-
-from six.moves.urllib.parse import urlencode
-from urllib.parse import quote_plus
-
-
-app = Flask(__name__)
-app.secret_key = 'SECRET_KEY'
-
-app.register_blueprint(employee.bp)
-app.register_blueprint(restaurant.bp)
-app.register_blueprint(user.bp)
-
-client = datastore.Client()
-
-
-
-
-oauth = OAuth(app)
-
-auth0 = oauth.register(
-    'auth0',
-    client_id=constants.CLIENT_ID,
-    client_secret=constants.CLIENT_SECRET,
-    api_base_url="https://" + constants.DOMAIN,
-    access_token_url="https://" + constants.DOMAIN + "/oauth/token",
-    authorize_url="https://" + constants.DOMAIN + "/authorize",
-    client_kwargs={
-        'scope': 'openid profile email',
-    },
-    server_metadata_url=f'https://{constants.DOMAIN}/.well-known/openid-configuration'
-)
+import logging
+import threading
+
+IMPORT_SECONDS = time.perf_counter() - _import_started
+
+logger = logging.getLogger(__name__)
+
+_oauth_lock = threading.Lock()
+
+
+def auth0():
+    """
+    Registers the Auth0 OAuth client on first use, so authlib is only imported (and the client only built) by
+    instances that actually serve a login
+    :return: the Auth0 client of the current app
+    """
+    oauth = current_app.extensions.get('authlib.integrations.flask_client')
+    if oauth is None:
+        with _oauth_lock:
+            oauth = current_app.extensions.get('authlib.integrations.flask_client')
+            if oauth is None:
+                from authlib.integrations.flask_client import OAuth
+                oauth = OAuth(current_app)
+                oauth.register(
+                    'auth0',
+                    client_id=constants.CLIENT_ID,
+                    client_secret=constants.CLIENT_SECRET,
+                    api_base_url="https://" + constants.DOMAIN,
+                    access_token_url="https://" + constants.DOMAIN + "/oauth/token",
+                    authorize_url="https://" + constants.DOMAIN + "/authorize",
+                    client_kwargs={
+                        'scope': 'openid profile email',
+                    },
+                    server_metadata_url=f'https://{constants.DOMAIN}/.well-known/openid-configuration'
+                )
+    return oauth.auth0
 
 
 # This code is adapted from:
 # https://auth0.com/docs/quickstart/backend/python/01-authorization?_ga=2.46956069.349333901.1589042886-466012638.1589042885#create-the-jwt-validation-decorator
 
-@app.route('/')
 def home():
     if session:
         user = session.get('user')
@@ -61,20 +67,10 @@ def home():
         sub = session.get('user')['userinfo']['sub']
 
         # check to see if this user already exists
-        query = client.query(kind=constants.users)
-        results = list(query.fetch())
-        for user_iter in results:
-            if user_iter["sub"] == sub:
-                print("RETURN VISITOR")
-                return render_template("home.html",
-                                       session=user,
-                                       pretty=json.dumps({'id_token': id_token,
-                                                          'sub': sub}))
-        new_owner = datastore.entity.Entity(key=client.key(constants.users))
-        new_owner.update({
-            'sub': sub})
-        client.put(new_owner)
-        print("NEW VISITOR")
+        if ensure_user(sub):
+            visitors.inc(type="new")
+        else:
+            visitors.inc(type="return")
         return render_template("home.html",
                                session=user,
                                pretty=json.dumps({'id_token': id_token,
@@ -88,21 +84,18 @@ def home():
 # Request: JSON body with 2 properties with "username" and "password"
 #       of a user registered with this Auth0 domain
 # Response: JSON with the JWT as the value of the property id_token
-@app.route('/login')
 def login():
-    return oauth.auth0.authorize_redirect(
+    return auth0().authorize_redirect(
         redirect_uri=url_for("callback", _external=True)
     )
 
 
-@app.route("/callback", methods=["GET", "POST"])
 def callback():
-    token = oauth.auth0.authorize_access_token()
+    token = auth0().authorize_access_token()
     session['user'] = token
     return redirect("/")
 
 
-@app.route("/logout")
 def logout():
     session.clear()
     return redirect(
@@ -118,13 +111,56 @@ def logout():
     )
 
 
-@app.errorhandler(AuthError)
 def handle_auth_error(ex):
     response = jsonify(ex.error)
     response.status_code = ex.status_code
     return response
 
 
+def create_app():
+    """
+    Builds the app. Nothing here talks to the network: the Datastore client, the JWKS and the Auth0 client are
+    all set up on first use, so a new instance can take its first request as soon as the imports are done.
+    :return: the Flask app
+    """
+    started = time.perf_counter()
+    app = Flask(__name__)
+    app.secret_key = 'SECRET_KEY'
+
+    app.register_blueprint(employee.bp)
+    app.register_blueprint(employee.batch_bp)
+    app.register_blueprint(restaurant.bp)
+    app.register_blueprint(restaurant.batch_bp)
+    app.register_blueprint(user.bp)
+    app.register_blueprint(jobs.bp)
+
+    app.add_url_rule('/', 'home', home)
+    app.add_url_rule('/login', 'login', login)
+    app.add_url_rule('/callback', 'callback', callback, methods=["GET", "POST"])
+    app.add_url_rule('/logout', 'logout', logout)
+    app.register_error_handler(AuthError, handle_auth_error)
+
+    # pick up the jobs an earlier instance didn't finish, without holding up startup
+    if constants.JOB_RESUME:
+        jobs.runner.start_resume()
+
+    Metrics(app)
+    # registered after Metrics: after_request hooks run in reverse, so Metrics sees the compressed sizes
+    Compression(app)
+    # before_request hooks run in order: Metrics starts its clock first, so rejected requests are timed too
+    AdmissionControl(app)
+    # last, so the captures include the other extensions' hooks but not requests they turned away
+    Profiler(app)
+
+    app.config["STARTUP_TIMES"] = {"imports": IMPORT_SECONDS, "create_app": time.perf_counter() - started}
+    logger.info("Started in %.1f ms (imports %.1f ms, create_app %.1f ms)",
+                sum(app.config["STARTUP_TIMES"].values()) * 1000, IMPORT_SECONDS * 1000,
+                app.config["STARTUP_TIMES"]["create_app"] * 1000)
+    return app
+
+
+app = create_app()
+
 
 """
 def login_user():
@@ -0,0 +1,241 @@
+from contextlib import contextmanager
+from flask import Response, g, has_request_context, request
+import bisect
+import sys
+import threading
+import time
+import constants
+
+
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+SIZE_BUCKETS = (100, 1000, 10000, 100000, 1000000, 10000000)
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _labels(names, values, extra=()):
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)] + list(extra)
+    return '{' + ','.join(pairs) + '}' if pairs else ''
+
+
+class Histogram:
+    """
+    Prometheus histogram with a fixed set of label names
+    """
+
+    def __init__(self, name, help, buckets=LATENCY_BUCKETS, labels=()):
+        self.name = name
+        self.help = help
+        self.buckets = buckets
+        self.label_names = labels
+        self._series = {}
+        self._lock = threading.Lock()
+
+    def observe(self, value, **labels):
+        label_values = tuple(labels.get(name, "") for name in self.label_names)
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            series = self._series.get(label_values)
+            if series is None:
+                # one count per bucket plus +Inf, then the sum
+                series = self._series[label_values] = [0] * (len(self.buckets) + 1) + [0.0]
+            series[index] += 1
+            series[-1] += value
+
+    def render(self):
+        lines = [f'# HELP {self.name} {self.help}', f'# TYPE {self.name} histogram']
+        with self._lock:
+            series = {label_values: list(counts) for label_values, counts in self._series.items()}
+        for label_values, counts in sorted(series.items()):
+            cumulative = 0
+            for bound, count in zip(self.buckets + ("+Inf",), counts):
+                cumulative += count
+                le = f'le="{bound}"'
+                lines.append(f'{self.name}_bucket{_labels(self.label_names, label_values, [le])} {cumulative}')
+            lines.append(f'{self.name}_sum{_labels(self.label_names, label_values)} {counts[-1]}')
+            lines.append(f'{self.name}_count{_labels(self.label_names, label_values)} {cumulative}')
+        return lines
+
+
+class Counter:
+    """
+    Prometheus counter with a fixed set of label names
+    """
+
+    def __init__(self, name, help, labels=()):
+        self.name = name
+        self.help = help
+        self.label_names = labels
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def inc(self, amount=1, **labels):
+        label_values = tuple(labels.get(name, "") for name in self.label_names)
+        with self._lock:
+            self._values[label_values] = self._values.get(label_values, 0) + amount
+
+    def render(self):
+        lines = [f'# HELP {self.name} {self.help}', f'# TYPE {self.name} counter']
+        with self._lock:
+            values = dict(self._values)
+        for label_values, value in sorted(values.items()):
+            lines.append(f'{self.name}{_labels(self.label_names, label_values)} {value}')
+        return lines
+
+
+request_latency = Histogram("http_request_duration_seconds", "Time spent handling a request",
+                            labels=("route", "method", "status"))
+response_size = Histogram("http_response_size_bytes", "Size of response bodies of known length",
+                          buckets=SIZE_BUCKETS, labels=("route",))
+datastore_latency = Histogram("datastore_rpc_duration_seconds", "Time spent in storage backend calls, by operation",
+                              labels=("op",))
+jwks_fetch_latency = Histogram("jwks_fetch_duration_seconds", "Time spent loading the JWKS")
+jwt_verify_latency = Histogram("jwt_verify_duration_seconds", "Time spent verifying the JWT of a request")
+visitors = Counter("visitors_total", "Logged in visitors of the home page", labels=("type",))
+compression_cpu = Histogram("compression_cpu_seconds", "CPU time spent compressing a response body",
+                            buckets=(0.0001, 0.00025, 0.0005) + LATENCY_BUCKETS, labels=("encoding",))
+compression_bytes = Counter("compression_bytes_total", "Response bytes before (in) and after (out) compression",
+                            labels=("encoding", "direction"))
+
+METRICS = [request_latency, response_size, datastore_latency, jwks_fetch_latency, jwt_verify_latency, visitors,
+           compression_cpu, compression_bytes]
+
+# name -> callable returning a dict of numbers (or None), exported as gauges named <name>_<key>
+_stats_sources = {}
+
+
+def register_stats(name, source):
+    """
+    Exports the counters of a cache (anything with a stats() dict) on /metrics
+    :param name: metric name prefix, e.g. "token_cache"
+    :param source: callable returning a dict of numbers, or None when there is nothing to report
+    """
+    _stats_sources[name] = source
+
+
+@contextmanager
+def timed(histogram, timing=None, **labels):
+    """
+    Times the block (or the decorated function) into the histogram, and adds the time to the request's
+    Server-Timing entry named `timing`
+    """
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        elapsed = time.perf_counter() - started
+        histogram.observe(elapsed, **labels)
+        if timing and has_request_context() and "server_timing" in g:
+            entry = g.server_timing.setdefault(timing, [0.0, 0])
+            entry[0] += elapsed
+            entry[1] += 1
+
+
+def render():
+    """
+    :return: every metric in the Prometheus text exposition format
+    """
+    lines = []
+    for metric in METRICS:
+        lines.extend(metric.render())
+    for name, source in sorted(_stats_sources.items()):
+        stats = source()
+        for key, value in sorted((stats or {}).items()):
+            lines.append(f'# TYPE {name}_{key} gauge')
+            lines.append(f'{name}_{key} {value}')
+    return '\n'.join(lines) + '\n'
+
+
+class InstrumentedBackend:
+    """
+    Storage backend wrapper timing every call into datastore_rpc_duration_seconds, by operation. Sits under the
+    entity cache so only calls that actually reach the backend are counted.
+    """
+
+    def __init__(self, backend):
+        self.backend = backend
+
+    def __getattr__(self, name):
+        return getattr(self.backend, name)
+
+    def get_multi(self, keys):
+        with timed(datastore_latency, "datastore", op="get"):
+            return self.backend.get_multi(keys)
+
+    def put_multi(self, entities):
+        with timed(datastore_latency, "datastore", op="put"):
+            return self.backend.put_multi(entities)
+
+    def delete_multi(self, keys):
+        with timed(datastore_latency, "datastore", op="delete"):
+            return self.backend.delete_multi(keys)
+
+    def allocate_ids(self, kind, count):
+        with timed(datastore_latency, "datastore", op="allocate_ids"):
+            return self.backend.allocate_ids(kind, count)
+
+    def run_query(self, *args, **kwargs):
+        with timed(datastore_latency, "datastore", op="query"):
+            return self.backend.run_query(*args, **kwargs)
+
+    @contextmanager
+    def transaction(self):
+        # the begin and the commit (or rollback) are the RPCs, not the work done inside the block
+        context = self.backend.transaction()
+        with timed(datastore_latency, "datastore", op="begin"):
+            transaction = context.__enter__()
+        exc_info = (None, None, None)
+        try:
+            yield transaction
+        except BaseException:
+            exc_info = sys.exc_info()
+            raise
+        finally:
+            with timed(datastore_latency, "datastore", op="commit" if exc_info[0] is None else "rollback"):
+                context.__exit__(*exc_info)
+
+
+class Metrics:
+    """
+    Flask extension recording per-route latency and response sizes, exposing every metric on /metrics and
+    reporting where a request's time went in a Server-Timing header.
+    """
+
+    def __init__(self, app=None):
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        app.before_request(self._before_request)
+        app.after_request(self._after_request)
+        app.add_url_rule('/metrics', 'metrics', self.metrics_get)
+
+    @staticmethod
+    def _before_request():
+        g.request_started = time.perf_counter()
+        g.server_timing = {}
+
+    @staticmethod
+    def _after_request(response):
+        if "request_started" not in g:
+            return response
+        elapsed = time.perf_counter() - g.request_started
+        route = request.url_rule.rule if request.url_rule is not None else "unmatched"
+        request_latency.observe(elapsed, route=route, method=request.method, status=response.status_code)
+
+        size = response.calculate_content_length()
+        if size is not None:
+            response_size.observe(size, route=route)
+
+        if constants.SERVER_TIMING:
+            entries = [f'app;dur={elapsed * 1000:.2f}']
+            for name, (total, count) in g.server_timing.items():
+                entries.append(f'{name};dur={total * 1000:.2f};desc="{count} calls"')
+            response.headers["Server-Timing"] = ', '.join(entries)
+        return response
+
+    @staticmethod
+    def metrics_get():
+        return Response(render(), mimetype="text/plain; version=0.0.4")
@@ -0,0 +1,33 @@
+from storage import InvalidCursor
+from urllib.parse import urlencode
+
+
+class Pagination:
+
+    @staticmethod
+    def fetch_page(repo, request, default_limit=5, **query_args):
+        """
+        Fetches one page of a query. Pages are addressed by an opaque `cursor` query parameter; `offset` is
+        still accepted for backward compatibility but makes Datastore skip over every earlier entity.
+        :param repo: storage.Repository of the listed kind
+        :param request: flask request carrying the limit, cursor and offset arguments
+        :param default_limit: page size when no limit is given
+        :param query_args: filters/order/projection passed on to the query
+        :return: list of entities on the page, url of the next page (None on the last page)
+        """
+        q_limit = int(request.args.get('limit', default_limit))
+        cursor = request.args.get('cursor')
+        if cursor:
+            results, next_cursor = repo.query(limit=q_limit, cursor=cursor, **query_args)
+        else:
+            q_offset = int(request.args.get('offset', '0'))
+            results, next_cursor = repo.query(limit=q_limit, offset=q_offset, **query_args)
+
+        next_url = None
+        if next_cursor:
+            args = request.args.to_dict()
+            args.pop('offset', None)
+            args['limit'] = q_limit
+            args['cursor'] = next_cursor
+            next_url = request.base_url + "?" + urlencode(args)
+        return results, next_url
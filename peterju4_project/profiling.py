@@ -0,0 +1,193 @@
+from collections import Counter as Tally
+from flask import g, request, send_from_directory
+from metrics import Counter, METRICS
+import cProfile
+import hmac
+import os
+import random
+import re
+import sys
+import threading
+import time
+import constants
+
+
+profiles_captured = Counter("profiles_captured_total", "Requests captured by the profiler", labels=("route", "trigger"))
+METRICS.append(profiles_captured)
+
+# never profiled: the scraper and the profile downloads themselves
+EXEMPT_ENDPOINTS = ("metrics", "profiles_list", "profiles_get")
+
+CAPTURE_SUFFIXES = (".pstats", ".collapsed")
+
+
+class StackSampler:
+    """
+    Samples the stack of one thread every `interval` seconds from a background thread, and counts the samples
+    per distinct stack. The result is in the collapsed format flamegraph.pl and speedscope read.
+    """
+
+    def __init__(self, thread_id, interval=constants.PROFILE_INTERVAL):
+        self.thread_id = thread_id
+        self.interval = interval
+        self.stacks = Tally()
+        self._stopped = threading.Event()
+        self._thread = threading.Thread(target=self._run, name="profile-sampler", daemon=True)
+
+    def start(self):
+        self._thread.start()
+
+    def stop(self):
+        self._stopped.set()
+        self._thread.join()
+
+    @staticmethod
+    def _frame_name(code):
+        return f'{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})'
+
+    def _run(self):
+        while not self._stopped.wait(self.interval):
+            frame = sys._current_frames().get(self.thread_id)
+            names = []
+            while frame is not None:
+                names.append(self._frame_name(frame.f_code))
+                frame = frame.f_back
+            if names:
+                self.stacks[';'.join(reversed(names))] += 1
+
+    def collapsed(self):
+        return ''.join(f'{stack} {count}\n' for stack, count in self.stacks.most_common())
+
+
+class Profiler:
+    """
+    Flask extension capturing where chosen requests spend their time, without a redeploy: requests carrying
+    PROFILE_TOKEN in an X-Profile header, plus a PROFILE_SAMPLE_RATE fraction of all requests.
+
+    Each capture is saved to PROFILE_DIR as a cProfile dump (<name>.pstats, for pstats or snakeviz) and the
+    stacks a sampler saw (<name>.collapsed, for a flame graph), named after the time, method, route, status
+    and duration. The response names the capture in X-Profile-Id. GET /profiles lists the captures of this
+    instance and GET /profiles/<file> downloads one; both need the token in X-Profile.
+
+    One request is captured at a time per instance; requests arriving meanwhile are served unprofiled. Register
+    it last, so the time spent in the other extensions' hooks (e.g. compression) is part of the capture.
+    """
+
+    def __init__(self, app=None):
+        self.directory = constants.PROFILE_DIR
+        self._capturing = threading.Lock()
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        app.before_request(self._before_request)
+        app.after_request(self._after_request)
+        app.teardown_request(self._teardown_request)
+        app.add_url_rule('/profiles', 'profiles_list', self.profiles_list)
+        app.add_url_rule('/profiles/<name>', 'profiles_get', self.profiles_get)
+
+    @staticmethod
+    def _privileged():
+        token = request.headers.get("X-Profile", "")
+        return bool(constants.PROFILE_TOKEN) and hmac.compare_digest(token.encode(), constants.PROFILE_TOKEN.encode())
+
+    def _before_request(self):
+        if request.endpoint in EXEMPT_ENDPOINTS or request.url_rule is None:
+            return None
+        if self._privileged():
+            trigger = "header"
+        elif constants.PROFILE_SAMPLE_RATE and random.random() < constants.PROFILE_SAMPLE_RATE:
+            trigger = "sample"
+        else:
+            return None
+        # one capture at a time bounds what profiling costs an instance: a sampler thread and cProfile's per-call
+        # overhead on one request, not on every request that happens to be chosen at once. It also keeps working on
+        # Python 3.12+, where cProfile registers through sys.monitoring and a second concurrent one fails to enable.
+        if not self._capturing.acquire(blocking=False):
+            return None
+
+        g.profile_trigger = trigger
+        g.profile_started = time.perf_counter()
+        g.profile_sampler = StackSampler(threading.get_ident())
+        g.profile_sampler.start()
+        g.profile = cProfile.Profile()
+        g.profile.enable()
+        return None
+
+    @staticmethod
+    def _after_request(response):
+        if "profile" in g:
+            g.profile_name = Profiler._capture_name(response.status_code)
+            response.headers["X-Profile-Id"] = g.profile_name
+        return response
+
+    @staticmethod
+    def _capture_name(status):
+        route = re.sub(r'[^A-Za-z0-9]+', '_', request.url_rule.rule).strip('_') or 'root'
+        elapsed = (time.perf_counter() - g.profile_started) * 1000
+        started = f'{time.strftime("%Y%m%dT%H%M%S")}-{random.getrandbits(16):04x}'
+        return f'{started}-{request.method}-{route}-{status}-{elapsed:.0f}ms'
+
+    def _teardown_request(self, exc):
+        profile = g.pop("profile", None)
+        if profile is None:
+            return
+        # teardown runs after a streamed body has been sent, so the capture covers producing it too
+        profile.disable()
+        sampler = g.pop("profile_sampler")
+        sampler.stop()
+        self._capturing.release()
+
+        name = g.pop("profile_name", None) or self._capture_name(500)
+        os.makedirs(self.directory, exist_ok=True)
+        profile.dump_stats(os.path.join(self.directory, f'{name}.pstats'))
+        with open(os.path.join(self.directory, f'{name}.collapsed'), "w") as collapsed_file:
+            collapsed_file.write(sampler.collapsed())
+        profiles_captured.inc(route=request.url_rule.rule, trigger=g.pop("profile_trigger"))
+        self._prune()
+
+    def _captures(self):
+        """
+        :return: the capture files of this instance, newest first
+        """
+        try:
+            entries = [entry for entry in os.scandir(self.directory) if entry.name.endswith(CAPTURE_SUFFIXES)]
+        except FileNotFoundError:
+            return []
+        return sorted(entries, key=lambda entry: (entry.stat().st_mtime, entry.name), reverse=True)
+
+    def _prune(self):
+        names = list(dict.fromkeys(os.path.splitext(entry.name)[0] for entry in self._captures()))
+        for name in names[constants.PROFILE_KEEP:]:
+            for suffix in CAPTURE_SUFFIXES:
+                try:
+                    os.remove(os.path.join(self.directory, name + suffix))
+                except FileNotFoundError:
+                    pass
+
+    def profiles_list(self):
+        if "application/json" not in request.accept_mimetypes:
+            return {"Error": "This endpoint only supports the return of JSON objects"}, 406
+        if not constants.PROFILE_TOKEN:
+            return {"Error": "Profiling is not enabled"}, 404
+        if not self._privileged():
+            return {"Error": "A valid X-Profile token is required"}, 403
+
+        captures = [{
+            "name": entry.name,
+            "size": entry.stat().st_size,
+            "self": f'{request.host_url}profiles/{entry.name}'
+        } for entry in self._captures()]
+        return {"profiles": captures}, 200
+
+    def profiles_get(self, name):
+        if not constants.PROFILE_TOKEN:
+            return {"Error": "Profiling is not enabled"}, 404
+        if not self._privileged():
+            return {"Error": "A valid X-Profile token is required"}, 403
+        if not name.endswith(CAPTURE_SUFFIXES):
+            return {"Error": "No profile with this name exists"}, 404
+
+        # send_from_directory refuses names leading outside the directory
+        return send_from_directory(self.directory, name, as_attachment=True,
+                                   mimetype="text/plain" if name.endswith(".collapsed") else "application/octet-stream")
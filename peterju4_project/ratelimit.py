@@ -0,0 +1,218 @@
+from flask import g, request
+from cache import LRUCache
+from entity_processing import JWTVerification
+from metrics import Counter, METRICS, register_stats
+import hashlib
+import math
+import threading
+import time
+import constants
+
+
+requests_rejected = Counter("requests_rejected_total", "Requests turned away by admission control",
+                            labels=("reason", "route"))
+METRICS.append(requests_rejected)
+
+# never limited: the scraper must keep working while the app sheds load
+EXEMPT_ENDPOINTS = ("metrics",)
+
+
+def parse_limit(spec):
+    """
+    :param spec: "<requests per second>:<burst>", e.g. "5:10"
+    :return: (rate, burst), or None for an empty spec. raises ValueError for a malformed spec, or for a rate or
+             burst that isn't positive, so a bad RATE_LIMIT_DEFAULT/RATE_LIMITS stops the app at startup.
+    """
+    if not spec:
+        return None
+    rate, _, burst = spec.partition(":")
+    try:
+        rate = float(rate)
+        burst = float(burst) if burst else max(rate, 1.0)
+    except ValueError:
+        raise ValueError(f'Invalid rate limit {spec!r}: expected "<requests per second>:<burst>"')
+    if rate <= 0 or burst <= 0:
+        raise ValueError(f'Invalid rate limit {spec!r}: the rate and the burst must be greater than 0')
+    return rate, burst
+
+
+def parse_route_limits(specs):
+    """
+    :param specs: comma separated "<METHOD> <rule>=<rate>:<burst>" items
+    :return: {"<METHOD> <rule>": (rate, burst)}
+    """
+    limits = {}
+    for item in filter(None, (spec.strip() for spec in specs.split(","))):
+        route, _, spec = item.rpartition("=")
+        limits[route.strip()] = parse_limit(spec)
+    return limits
+
+
+class LocalBucketStore:
+    """
+    Token buckets kept in process, bounded to the most recently seen RATE_LIMIT_KEYS subjects
+    """
+
+    def __init__(self, max_keys=constants.RATE_LIMIT_KEYS):
+        self._buckets = LRUCache(max_keys)
+        self._lock = threading.Lock()
+
+    def take(self, key, rate, burst, cost=1.0):
+        """
+        :return: 0 if the tokens were taken, otherwise the seconds until enough of them will be available
+        """
+        now = time.monotonic()
+        with self._lock:
+            tokens, updated = self._buckets.get(key) or (burst, now)
+            tokens = min(burst, tokens + (now - updated) * rate)
+            if tokens >= cost:
+                self._buckets.set(key, (tokens - cost, now))
+                return 0.0
+            self._buckets.set(key, (tokens, now))
+        return (cost - tokens) / rate
+
+
+class RedisBucketStore:
+    """
+    Token buckets kept in Redis, so every instance draws on the same bucket per subject. Needs the optional
+    `redis` package.
+    """
+
+    # refill and take in one round trip, atomically
+    SCRIPT = """
+local rate, burst, cost, now = tonumber(ARGV[1]), tonumber(ARGV[2]), tonumber(ARGV[3]), tonumber(ARGV[4])
+local bucket = redis.call('HMGET', KEYS[1], 'tokens', 'updated')
+local tokens = tonumber(bucket[1]) or burst
+local updated = tonumber(bucket[2]) or now
+tokens = math.min(burst, tokens + math.max(now - updated, 0) * rate)
+local wait = 0
+if tokens >= cost then
+    tokens = tokens - cost
+else
+    wait = (cost - tokens) / rate
+end
+redis.call('HSET', KEYS[1], 'tokens', tokens, 'updated', now)
+redis.call('PEXPIRE', KEYS[1], math.ceil(burst / rate * 1000) + 1000)
+return tostring(wait)
+"""
+
+    def __init__(self, url=constants.RATE_LIMIT_REDIS_URL, prefix="ratelimit:"):
+        try:
+            import redis
+        except ImportError:
+            raise RuntimeError("RATE_LIMIT_REDIS_URL is set but the redis package is not installed")
+        self._redis = redis.Redis.from_url(url)
+        self._take = self._redis.register_script(self.SCRIPT)
+        self.prefix = prefix
+
+    def take(self, key, rate, burst, cost=1.0):
+        return float(self._take(keys=[f'{self.prefix}{key}'], args=[rate, burst, cost, time.time()]))
+
+
+class AdmissionControl:
+    """
+    Flask extension deciding whether a request is served at all, before any handler work:
+
+    - a token bucket per subject and route answers 429 with Retry-After once a caller exceeds its rate. The
+      subject is the sub of an already verified token (looked up in the token cache, so nothing is verified
+      here), otherwise the client IP (see RATE_LIMIT_TRUSTED_PROXIES).
+    - a global cap on concurrent requests makes further requests wait for a slot, but only as long as they can
+      still finish within LATENCY_SLO; the rest are shed with 503 and Retry-After.
+    """
+
+    def __init__(self, app=None):
+        self.default_limit = parse_limit(constants.RATE_LIMIT_DEFAULT)
+        self.route_limits = parse_route_limits(constants.RATE_LIMITS)
+        self.store = RedisBucketStore() if constants.RATE_LIMIT_REDIS_URL else LocalBucketStore()
+
+        self.max_concurrent = constants.MAX_CONCURRENT_REQUESTS
+        self._slots = threading.BoundedSemaphore(self.max_concurrent) if self.max_concurrent else None
+        self._in_flight = 0
+        self._in_flight_lock = threading.Lock()
+        # moving average of the time a request holds its slot, used to predict the wait for one
+        self._service_time = 0.05
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        app.before_request(self._before_request)
+        app.teardown_request(self._teardown_request)
+        register_stats("admission", self.stats)
+
+    @staticmethod
+    def _subject():
+        auth_header = request.headers.get('Authorization', '').split()
+        if len(auth_header) == 2:
+            # peek: the lookup verify_jwt makes afterwards is the one the token cache's hit ratio should count
+            payload = JWTVerification.token_cache.peek(hashlib.sha256(auth_header[1].encode()).hexdigest())
+            if payload is not None:
+                return f'sub:{payload["sub"]}'
+        return f'ip:{AdmissionControl._client_address()}'
+
+    @staticmethod
+    def _client_address():
+        # X-Forwarded-For entries left of the ones our proxies appended are whatever the client sent: only the
+        # entry the nearest of RATE_LIMIT_TRUSTED_PROXIES proxies appended can be trusted
+        proxies = constants.RATE_LIMIT_TRUSTED_PROXIES
+        forwarded = [address.strip() for address in request.headers.get("X-Forwarded-For", "").split(",")
+                     if address.strip()]
+        if proxies <= 0 or len(forwarded) < proxies:
+            return request.remote_addr
+        return forwarded[-proxies]
+
+    def _rate_limited(self, route):
+        limit = self.route_limits.get(route, self.default_limit)
+        if limit is None:
+            return None
+        rate, burst = limit
+
+        # a page of 500 rows costs more than a page of 5
+        cost = 1.0
+        if 'limit' in request.args and request.args['limit'].isdigit():
+            cost = max(1.0, int(request.args['limit']) / constants.RATE_LIMIT_ROWS_PER_TOKEN)
+        wait = self.store.take(f'{self._subject()}|{route}', rate, burst, min(cost, burst))
+        if wait <= 0:
+            return None
+        requests_rejected.inc(reason="rate_limit", route=route)
+        return {"Error": "Too many requests"}, 429, {"Retry-After": str(math.ceil(wait))}
+
+    def _acquire_slot(self, route):
+        if self._slots.acquire(blocking=False):
+            return None
+        budget = constants.LATENCY_SLO - self._service_time
+        if budget > 0 and self._slots.acquire(timeout=budget):
+            return None
+        requests_rejected.inc(reason="overload", route=route)
+        return {"Error": "The service is overloaded"}, 503, {"Retry-After": str(max(1, math.ceil(self._service_time)))}
+
+    def _before_request(self):
+        if request.endpoint in EXEMPT_ENDPOINTS or request.url_rule is None:
+            return None
+        route = f'{request.method} {request.url_rule.rule}'
+
+        rejection = self._rate_limited(route)
+        if rejection:
+            return rejection
+
+        if self._slots is not None:
+            rejection = self._acquire_slot(route)
+            if rejection:
+                return rejection
+            g.admission_started = time.perf_counter()
+        with self._in_flight_lock:
+            self._in_flight += 1
+        g.admitted = True
+        return None
+
+    def _teardown_request(self, exc):
+        if not g.pop("admitted", False):
+            return
+        with self._in_flight_lock:
+            self._in_flight -= 1
+        if "admission_started" in g:
+            self._service_time = 0.9 * self._service_time + 0.1 * (time.perf_counter() - g.admission_started)
+            self._slots.release()
+
+    def stats(self):
+        return {"in_flight": self._in_flight, "max_concurrent": self.max_concurrent,
+                "service_time_seconds": self._service_time}
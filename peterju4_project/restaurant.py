@@ -1,13 +1,77 @@
-from flask import Blueprint, request
-from google.cloud import datastore
+from contextlib import nullcontext
+from flask import Blueprint, request, Response, stream_with_context
+from batching import BatchOperations, MAX_BATCH_SIZE, chunked
+import storage
+import jobs
+from counters import ShardedCounter
+from pagination import Pagination, InvalidCursor
+from etags import ETag
+from filters import ListFilters
+from fields import Fieldsets
+from loader import EntityLoader
 from entity_processing import EntityProcessing, ContentValidation, JWTVerification
 import json
 import constants
 
-client = datastore.Client()
+restaurant_repo = storage.repository(constants.restaurants)
+employee_repo = storage.repository(constants.employees)
+restaurants_counter = ShardedCounter(constants.restaurants)
 
 bp = Blueprint('restaurant', __name__, url_prefix='/restaurants')
 
+# POST /restaurants:batch sits next to the collection url rather than under it, so it can't use the url_prefix
+batch_bp = Blueprint('restaurant_batch', __name__)
+
+
+def _delete_all(progress=None):
+    deleted = BatchOperations.delete_all(restaurant_repo, progress=progress)
+    restaurants_counter.reset()
+    return deleted
+
+
+jobs.runner.register("delete-all-restaurants", _delete_all)
+
+
+def _release_staff(progress=None, restaurant_id=None):
+    """
+    Clears the workplace of everyone still working at a deleted restaurant. Safe to re-run: each pass only
+    finds the employees not released yet.
+    :return: number of employees released
+    """
+    released = 0
+    while True:
+        staff, _ = employee_repo.query(filters=[("workplace.id", "=", restaurant_id)], limit=MAX_BATCH_SIZE)
+        if not staff:
+            return released
+        for emp in staff:
+            emp["workplace"] = None
+        employee_repo.put_multi(staff)
+        released += len(staff)
+        if progress:
+            progress(released)
+
+
+# still registered for the records of jobs submitted before delete-restaurant took over
+jobs.runner.register("release-staff", _release_staff)
+
+
+def _delete_restaurant(progress=None, restaurant_id=None):
+    """
+    Deletes a restaurant, then releases its staff. The job record is written before anything is deleted, so a
+    run cut short is resumed from it; deleting a restaurant that is already gone is skipped.
+    :return: number of employees released
+    """
+    with storage.transaction():
+        deleted = restaurant_repo.get(restaurant_id) is not None
+        if deleted:
+            restaurant_repo.delete(restaurant_id)
+    if deleted:
+        restaurants_counter.increment(-1)
+    return _release_staff(progress, restaurant_id=restaurant_id)
+
+
+jobs.runner.register("delete-restaurant", _delete_restaurant)
+
 
 @bp.route('/all', methods=['DELETE'])
 def restaurants_delete_all():
@@ -15,14 +79,35 @@ def restaurants_delete_all():
         return {"Error": "This endpoint only supports the return of JSON objects"}, 406
 
     if request.method == "DELETE":
-        query = client.query(kind=constants.restaurants)
-        results = list(query.fetch())
-        for e in results:
-            restaurant_key = client.key(constants.restaurants, int(e.key.id))
-            client.delete(restaurant_key)
+        # ?background=true runs large wipes as a job that can be polled at /jobs/<id>
+        if request.args.get('background', 'false').lower() == 'true':
+            job = jobs.runner.submit("delete-all-restaurants")
+            return {"id": job["id"], "self": f'{request.host_url}jobs/{job["id"]}'}, 202
+
+        _delete_all()
         return {"Success": "Deleted all restaurants"}, 204
 
 
+@batch_bp.route('/restaurants:batch', methods=['POST'])
+def restaurants_post_batch():
+    if "application/json" not in request.accept_mimetypes:
+        return {"Error": "This endpoint only supports the return of JSON objects"}, 406
+    payload = JWTVerification.verify_jwt(request)
+
+    try:
+        items = BatchOperations.parse_items(request)
+    except ValueError as ex:
+        return {"Error": str(ex)}, 400
+
+    # validate every item, allocate ids in bulk and write with chunked put_multi
+    results = BatchOperations.create_all(restaurant_repo, items, {'owner': payload['sub']})
+
+    output = BatchOperations.describe_results(results, f'{request.host_url}restaurants/')
+    if output["created"]:
+        restaurants_counter.increment(output["created"])
+    return output, 200
+
+
 @bp.route('', methods=['POST', 'GET'])
 def restaurants_post_get():
     if "application/json" not in request.accept_mimetypes:
@@ -42,51 +127,86 @@ def restaurants_post_get():
         content['owner'] = payload['sub']
 
         # create
-        new_restaurant = datastore.entity.Entity(key=client.key(constants.restaurants))
+        new_restaurant = restaurant_repo.new()
 
         # update
         new_restaurant = EntityProcessing.update_entity_all(content, constants.restaurants, new_restaurant)
 
-        client.put(new_restaurant)
+        restaurant_repo.put(new_restaurant)
+        restaurants_counter.increment()
+        ETag.strip(new_restaurant)
         new_restaurant["id"] = new_restaurant.key.id
         new_restaurant["self"] = f'{request.url}/{new_restaurant.key.id}'
 
         return new_restaurant, 201
 
-    # Get ALL restaurants, with pagination (limit = 5):
+    # Get ALL restaurants, with pagination (limit = 5), optionally filtered by owner/cuisine/cost:
     elif request.method == 'GET':
-        query = client.query(kind=constants.restaurants)
-        count = len(list(query.fetch()))
-        q_limit = int(request.args.get('limit', '5'))
-        q_offset = int(request.args.get('offset', '0'))
-        g_iterator = query.fetch(limit=q_limit, offset=q_offset)
-        pages = g_iterator.pages
-        results = list(next(pages))
-        if g_iterator.next_page_token:
-            next_offset = q_offset + q_limit
-            next_url = request.base_url + "?limit=" + str(q_limit) + "&offset=" + str(next_offset)
+        try:
+            query_args = ListFilters.restaurants(request, payload)
+            # ?fields=name,id returns only those columns, read with a projection or keys-only query when possible
+            fields = Fieldsets.parse(request, constants.restaurants)
+        except ValueError as ex:
+            return {"Error": str(ex)}, 400
+        query_args.update(Fieldsets.query_args(fields, constants.restaurants, query_args))
+        try:
+            results, next_url = Pagination.fetch_page(restaurant_repo, request, **query_args)
+        except InvalidCursor:
+            return {"Error": "The cursor is invalid"}, 400
+        if fields is not None:
+            results = [Fieldsets.render(e, fields, f'{request.base_url}/') for e in results]
         else:
-            next_url = None
-        for e in results:
-            e["id"] = e.key.id
-            e["self"] = f'{request.url}/{e.key.id}'
-        output = {
-            "count": count,
-            "restaurants": results
-        }
+            for e in results:
+                ETag.strip(e)
+                e["id"] = e.key.id
+                e["self"] = f'{request.base_url}/{e.key.id}'
+        output = {}
+        # ?count=false skips the count for callers that don't need it; recommended when paging a filtered list,
+        # whose count walks the matching keys (up to FILTERED_COUNT_LIMIT) on every page
+        if request.args.get('count', 'true').lower() != 'false':
+            counted = ListFilters.count(restaurant_repo, query_args)
+            output.update(counted if counted is not None else {"count": restaurants_counter.value()})
+        output["restaurants"] = results
         if next_url:
             output["next"] = next_url
         return json.dumps(output)
 
 
+@bp.route('/export', methods=['GET'])
+def restaurants_export():
+    if "application/x-ndjson" not in request.accept_mimetypes and "application/json" not in request.accept_mimetypes:
+        return {"Error": "This endpoint only supports the return of NDJSON"}, 406
+    payload = JWTVerification.verify_jwt(request)
+
+    # ?owner=me (or an owner's sub) limits the export to one owner's restaurants
+    filters = []
+    owner = request.args.get('owner')
+    if owner:
+        filters.append(("owner", "=", payload['sub'] if owner == 'me' else owner))
+
+    self_url = f'{request.host_url}restaurants/'
+
+    def generate():
+        # one cursor-addressed batch in memory at a time, however big the kind is
+        for e in restaurant_repo.iterate(filters=filters, batch_size=constants.EXPORT_BATCH_SIZE):
+            ETag.strip(e)
+            e["id"] = e.key.id
+            e["self"] = f'{self_url}{e.key.id}'
+            yield json.dumps(e) + "\n"
+
+    return Response(stream_with_context(generate()), mimetype="application/x-ndjson")
+
+
 @bp.route('/<id>', methods=['GET', 'DELETE', 'PUT', 'PATCH'])
 def restaurants_get_delete_update(id):
     if "application/json" not in request.accept_mimetypes:
         return {"Error": "This endpoint only supports the return of JSON objects"}, 406
     payload = JWTVerification.verify_jwt(request)
 
-    restaurant_key = client.key(constants.restaurants, int(id))
-    restaurant = client.get(key=restaurant_key)
+    # only GETs are served from the entity cache: a restaurant that is written back must be the committed one,
+    # not a snapshot another instance may have changed since
+    with storage.uncached() if request.method != 'GET' else nullcontext():
+        restaurant = EntityLoader.current().get(restaurant_repo, int(id))
 
     existence_error = ContentValidation.validate_entity_exists(entity_type=constants.restaurants, entity=restaurant)
     if existence_error:
@@ -98,22 +218,36 @@ def restaurants_get_delete_update(id):
 
     # Get a specific restaurant
     if request.method == 'GET':
+        if ETag.not_modified(request, restaurant):
+            return '', 304, ETag.header(restaurant)
 
+        headers = ETag.header(restaurant)
+        ETag.strip(restaurant)
         restaurant["id"] = restaurant.key.id
         restaurant["self"] = f"{request.url}"
-        return restaurant, 200
+        return restaurant, 200, headers
 
     # Delete a restaurant
     elif request.method == 'DELETE':
 
-        # remove all employees from restaurant
-        for employee in restaurant["employees"]:
-            employee_key = client.key(constants.employees, int(employee["id"]))
-            emp = client.get(key=employee_key)
-            emp["workplace"] = None
-            client.put(emp)
-
-        client.delete(restaurant_key)
+        # restaurants with large rosters (or ?background=true) are deleted by a job that can be polled at /jobs/<id>
+        background = request.args.get('background', 'false').lower() == 'true'
+        if background or restaurant.get("employee_count", 0) >= MAX_BATCH_SIZE:
+            job = jobs.runner.submit("delete-restaurant", restaurant_id=restaurant.key.id)
+            return {"id": job["id"], "self": f'{request.host_url}jobs/{job["id"]}'}, 202
+
+        # remove all employees from restaurant; read them all first, as clearing workplaces shrinks the query
+        staff = list(employee_repo.iterate(filters=[("workplace.id", "=", restaurant.key.id)]))
+
+        # a transaction commits at most 500 mutations: the roster writes plus the restaurant delete
+        cascade = storage.transaction() if len(staff) < MAX_BATCH_SIZE else nullcontext()
+        with cascade:
+            for emp in staff:
+                emp["workplace"] = None
+            employee_repo.put_multi(staff)
+            restaurant_repo.delete(restaurant.key.id)
+        EntityLoader.current().forget(restaurant_repo, restaurant.key.id)
+        restaurants_counter.increment(-1)
         return '', 204
 
     # Update all attributes of a restaurant
@@ -125,11 +259,16 @@ def restaurants_get_delete_update(id):
         if content_error:
             return content_error
 
-        # update
-        restaurant = EntityProcessing.update_entity_all(content, constants.restaurants, restaurant)
+        # update; with If-Match the restaurant is re-read and written in one transaction so no other write slips in
+        with storage.transaction() if request.if_match else nullcontext():
+            if request.if_match:
+                restaurant = restaurant_repo.get(restaurant.key.id)
+                if ETag.precondition_failed(request, restaurant):
+                    return {"Error": "The restaurant has been modified since it was retrieved"}, 412
+            restaurant = EntityProcessing.update_entity_all(content, constants.restaurants, restaurant)
 
-        client.put(restaurant)
-        return '', 204
+            restaurant_repo.put(restaurant)
+        return '', 204, ETag.header(restaurant)
 
     # Update some attributes of a restaurant
     elif request.method == 'PATCH':
@@ -140,57 +279,128 @@ def restaurants_get_delete_update(id):
         if content_error:
             return content_error
 
-        # update
-        restaurant = EntityProcessing.update_entity_some(content, restaurant)
+        # update; with If-Match the restaurant is re-read and written in one transaction so no other write slips in
+        with storage.transaction() if request.if_match else nullcontext():
+            if request.if_match:
+                restaurant = restaurant_repo.get(restaurant.key.id)
+                if ETag.precondition_failed(request, restaurant):
+                    return {"Error": "The restaurant has been modified since it was retrieved"}, 412
+            restaurant = EntityProcessing.update_entity_some(content, restaurant)
 
-        client.put(restaurant)
-        return '', 204
+            restaurant_repo.put(restaurant)
+        return '', 204, ETag.header(restaurant)
     else:
         return 'Method not recognized'
 
 
-@bp.route('/<restaurant_id>/employees/<employee_id>', methods=['PUT', 'DELETE'])
-def add_delete_employee_with_restaurant(restaurant_id, employee_id):
-
+@bp.route('/<id>/employees', methods=['GET'])
+def restaurant_employees_get(id):
     if "application/json" not in request.accept_mimetypes:
         return {"Error": "This endpoint only supports the return of JSON objects"}, 406
-
     payload = JWTVerification.verify_jwt(request)
 
-    restaurant_key = client.key(constants.restaurants, int(restaurant_id))
-    restaurant = client.get(key=restaurant_key)
-    employee_key = client.key(constants.employees, int(employee_id))
-    employee = client.get(key=employee_key)
+    restaurant = EntityLoader.current().get(restaurant_repo, int(id))
+
+    existence_error = ContentValidation.validate_entity_exists(entity_type=constants.restaurants, entity=restaurant)
+    if existence_error:
+        return existence_error
 
     authorization_error = JWTVerification.authorize_protected_resource(restaurant, payload)
     if authorization_error:
         return authorization_error
 
-    # connect an employee with a restaurant
-    if request.method == 'PUT':
-        # validate
-        hiring_error = ContentValidation.validation_employee_hire(employee, restaurant)
-        if hiring_error:
-            return hiring_error
+    # Get the restaurant's employees, with pagination (limit = 5)
+    try:
+        results, next_url = Pagination.fetch_page(employee_repo, request,
+                                                  filters=[("workplace.id", "=", restaurant.key.id)])
+    except InvalidCursor:
+        return {"Error": "The cursor is invalid"}, 400
+    for e in results:
+        ETag.strip(e)
+        e["id"] = e.key.id
+        e["self"] = f'{request.host_url}employees/{e.key.id}'
+    output = {"count": restaurant.get("employee_count", 0), "employees": results}
+    if next_url:
+        output["next"] = next_url
+    return json.dumps(output)
 
-        # update entities
-        restaurant, employee = EntityProcessing.link_restaurant_and_employee(restaurant, employee, request)
 
-        client.put(restaurant)
-        client.put(employee)
-        return '', 204
+@bp.route('/<restaurant_id>/employees/<employee_id>', methods=['PUT', 'DELETE'])
+def add_delete_employee_with_restaurant(restaurant_id, employee_id):
 
-    # remove connection between an employee and a restaurant
-    if request.method == 'DELETE':
-        # validate
-        removal_error = ContentValidation.validation_employee_removal(employee, restaurant)
-        if removal_error:
-            return removal_error
+    if "application/json" not in request.accept_mimetypes:
+        return {"Error": "This endpoint only supports the return of JSON objects"}, 406
 
-        # update
-        employee, restaurant = EntityProcessing.remove_employee_from_restaurant(employee, restaurant)
+    payload = JWTVerification.verify_jwt(request)
 
-        client.put(restaurant)
-        client.put(employee)
-        return '', 204
+    # both entities are read (in one lookup) and written in one transaction so concurrent hires can't skew the
+    # head count
+    with storage.transaction():
+        restaurant, employee = EntityLoader.current().get_many([(restaurant_repo, int(restaurant_id)),
+                                                                (employee_repo, int(employee_id))])
+
+        for entity_type, entity in ((constants.restaurants, restaurant), (constants.employees, employee)):
+            existence_error = ContentValidation.validate_entity_exists(entity_type=entity_type, entity=entity)
+            if existence_error:
+                return existence_error
+
+        authorization_error = JWTVerification.authorize_protected_resource(restaurant, payload)
+        if authorization_error:
+            return authorization_error
+
+        # connect an employee with a restaurant
+        if request.method == 'PUT':
+            # validate
+            hiring_error = ContentValidation.validation_employee_hire(employee, restaurant)
+            if hiring_error:
+                return hiring_error
+
+            # update entities
+            restaurant, employee = EntityProcessing.link_restaurant_and_employee(restaurant, employee, request)
+
+            restaurant_repo.put(restaurant)
+            employee_repo.put(employee)
+            return '', 204
+
+        # remove connection between an employee and a restaurant
+        if request.method == 'DELETE':
+            # validate
+            removal_error = ContentValidation.validation_employee_removal(employee, restaurant)
+            if removal_error:
+                return removal_error
+
+            # update
+            employee, restaurant = EntityProcessing.remove_employee_from_restaurant(employee, restaurant)
+
+            restaurant_repo.put(restaurant)
+            employee_repo.put(employee)
+            return '', 204
+
+
+def migrate_rosters(progress=None):
+    """
+    One-off migration: drops the employee list embedded in restaurants written before rosters moved onto the
+    employees' workplace, keeping only its head count
+    :param progress: optional callable receiving the number of restaurants migrated so far
+    :return: number of restaurants migrated
+    """
+    migrated = 0
+    for batch in chunked(restaurant_repo.iterate()):
+        legacy_restaurants = [e for e in batch if "employees" in e]
+        if not legacy_restaurants:
+            continue
+        for restaurant in legacy_restaurants:
+            restaurant["employee_count"] = len(restaurant.pop("employees") or [])
+        restaurant_repo.put_multi(legacy_restaurants)
+        migrated += len(legacy_restaurants)
+        if progress:
+            progress(migrated)
+    return migrated
+
+
+if __name__ == '__main__':
+    # python restaurant.py migrate
+    import sys
+    if sys.argv[1:] == ['migrate']:
+        print(f'Migrated {migrate_rosters()} restaurants')
 
@@ -0,0 +1,234 @@
+"""
+Snapshot export and restore, for seeding staging and performance environments without replaying requests.
+
+    python snapshot.py export snapshot.jsonl
+    python snapshot.py import snapshot.jsonl
+    python snapshot.py import restaurants.ndjson --kind restaurants     # e.g. a GET /restaurants/export download
+
+A snapshot is JSONL: one entity per line with its "kind" and its "id" in the source environment. Restored
+entities get fresh ids, allocated in bulk; employees' workplace links are rewritten to the new restaurant ids.
+The file is read through a memory map, restaurants first and then everything else, and writes go out as
+parallel chunked put_multi calls with a bounded number in flight, so memory stays flat apart from the
+restaurant id map.
+
+Restoring into a non-empty environment adds to what is there; wipe it first (DELETE /<kind>/all) for a copy.
+"""
+from concurrent.futures import ThreadPoolExecutor
+from collections import deque
+import argparse
+import json
+import logging
+import mmap
+import os
+import sys
+import time
+
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from batching import MAX_BATCH_SIZE
+from counters import ShardedCounter
+import storage
+import constants
+
+
+logger = logging.getLogger(__name__)
+
+KINDS = (constants.restaurants, constants.employees, constants.users)
+
+# properties that describe the entity in the source environment rather than belong to it
+DROPPED = ("kind", "id", "self", "etag")
+
+
+def read_lines(path):
+    """
+    :param path: JSONL file
+    :return: generator of (line number, parsed line), skipping blank lines
+    """
+    with open(path, "rb") as snapshot_file:
+        if os.fstat(snapshot_file.fileno()).st_size == 0:
+            return
+        with mmap.mmap(snapshot_file.fileno(), 0, access=mmap.ACCESS_READ) as lines:
+            number = 0
+            for line in iter(lines.readline, b""):
+                number += 1
+                if line.strip():
+                    yield number, json.loads(line)
+
+
+def export(path, progress_every=10000):
+    """
+    Writes every restaurant, employee and user to a snapshot file
+    :return: number of entities written per kind
+    """
+    counts = {}
+    with open(path, "w") as snapshot_file:
+        for kind in KINDS:
+            counts[kind] = 0
+            for entity in storage.repository(kind).iterate():
+                row = {"kind": kind, "id": entity.key.id_or_name}
+                row.update(entity)
+                snapshot_file.write(json.dumps(row, default=str) + "\n")
+                counts[kind] += 1
+                if counts[kind] % progress_every == 0:
+                    logger.info("Exported %d %s", counts[kind], kind)
+    return counts
+
+
+class SnapshotImport:
+    """
+    One restore of a snapshot file into the configured storage backend
+    """
+
+    def __init__(self, path, default_kind=None, workers=8, chunk_size=MAX_BATCH_SIZE):
+        """
+        :param path: JSONL snapshot
+        :param default_kind: kind of the lines that don't name one, e.g. for files from the export endpoints
+        :param workers: put_multi calls in flight at once
+        :param chunk_size: entities per put_multi
+        """
+        self.path = path
+        self.default_kind = default_kind
+        self.workers = workers
+        self.chunk_size = chunk_size
+        # source restaurant id -> restored restaurant id
+        self.restaurant_ids = {}
+        self.counts = {kind: 0 for kind in KINDS}
+        self.skipped = 0
+
+    def _rows(self, kinds):
+        for number, row in read_lines(self.path):
+            kind = row.get("kind", self.default_kind)
+            if kind not in KINDS:
+                logger.warning("Line %d: unknown kind %r, skipped", number, kind)
+                self.skipped += 1
+                continue
+            if kind in kinds:
+                yield kind, row
+
+    @staticmethod
+    def _properties(row):
+        return {prop: value for prop, value in row.items() if prop not in DROPPED}
+
+    def _write_restaurants(self, rows):
+        repo = storage.repository(constants.restaurants)
+        ids = repo.allocate_ids(len(rows))
+        entities = []
+        for row, new_id in zip(rows, ids):
+            properties = self._properties(row)
+            # snapshots taken before rosters moved onto the employees carry the list itself
+            if "employees" in properties:
+                properties["employee_count"] = len(properties.pop("employees") or [])
+            entity = repo.new(new_id)
+            entity.update(properties)
+            entities.append(entity)
+        repo.put_multi(entities)
+        return [(row.get("id"), new_id) for row, new_id in zip(rows, ids)]
+
+    def _write_employees(self, rows):
+        repo = storage.repository(constants.employees)
+        ids = repo.allocate_ids(len(rows))
+        entities = []
+        for row, new_id in zip(rows, ids):
+            properties = self._properties(row)
+            workplace = properties.get("workplace")
+            if workplace:
+                restaurant_id = self.restaurant_ids.get(workplace.get("id"))
+                if restaurant_id is None:
+                    # the restaurant isn't in the snapshot: restore the employee unemployed
+                    properties["workplace"] = None
+                else:
+                    self_url = workplace.get("self", "").rsplit("/", 1)[0]
+                    properties["workplace"] = dict(workplace, id=restaurant_id, self=f'{self_url}/{restaurant_id}')
+            entity = repo.new(new_id)
+            entity.update(properties)
+            entities.append(entity)
+        repo.put_multi(entities)
+        return len(entities)
+
+    @staticmethod
+    def _write_users(rows):
+        # users are keyed by their sub, which is the same in every environment
+        repo = storage.repository(constants.users)
+        entities = []
+        for row in rows:
+            entity = repo.new(row.get("sub") or row["id"])
+            entity.update(SnapshotImport._properties(row))
+            entities.append(entity)
+        repo.put_multi(entities)
+        return len(entities)
+
+    def _pass(self, executor, kinds, on_result):
+        """
+        Streams the rows of the given kinds through the executor, one chunk per kind at a time, keeping at most
+        two chunks per worker in flight
+        """
+        writers = {constants.restaurants: self._write_restaurants, constants.employees: self._write_employees,
+                   constants.users: self._write_users}
+        in_flight = deque()
+        chunks = {kind: [] for kind in kinds}
+
+        def flush(kind):
+            in_flight.append((kind, len(chunks[kind]), executor.submit(writers[kind], chunks[kind])))
+            chunks[kind] = []
+            while len(in_flight) > self.workers * 2:
+                finish(*in_flight.popleft())
+
+        def finish(kind, size, future):
+            on_result(kind, future.result())
+            self.counts[kind] += size
+            every = self.chunk_size * 20
+            if self.counts[kind] // every != (self.counts[kind] - size) // every:
+                logger.info("Restored %d %s", self.counts[kind], kind)
+
+        for kind, row in self._rows(kinds):
+            chunks[kind].append(row)
+            if len(chunks[kind]) == self.chunk_size:
+                flush(kind)
+        for kind in kinds:
+            if chunks[kind]:
+                flush(kind)
+        while in_flight:
+            finish(*in_flight.popleft())
+
+    def run(self):
+        """
+        :return: number of entities restored per kind
+        """
+        started = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix="snapshot") as executor:
+            # restaurants first: the employees' workplace links need their new ids
+            self._pass(executor, (constants.restaurants,),
+                       lambda kind, mapping: self.restaurant_ids.update(mapping))
+            self._pass(executor, (constants.employees, constants.users), lambda kind, result: None)
+
+        # the list endpoints count with sharded counters; add what was restored
+        for kind in (constants.restaurants, constants.employees):
+            if self.counts[kind]:
+                ShardedCounter(kind).increment(self.counts[kind])
+        logger.info("Restored %s in %.1f s (%d lines skipped)", self.counts, time.perf_counter() - started,
+                    self.skipped)
+        return self.counts
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Export or restore a snapshot of restaurants, employees and users")
+    commands = parser.add_subparsers(dest="command", required=True)
+    export_parser = commands.add_parser("export", help="write every entity to a JSONL snapshot")
+    export_parser.add_argument("path")
+    import_parser = commands.add_parser("import", help="restore a JSONL snapshot")
+    import_parser.add_argument("path")
+    import_parser.add_argument("--kind", choices=KINDS, help="kind of the lines that don't name one")
+    import_parser.add_argument("--workers", type=int, default=8, help="put_multi calls in flight (default 8)")
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s %(message)s")
+    if args.command == "export":
+        print(json.dumps(export(args.path)))
+    else:
+        print(json.dumps(SnapshotImport(args.path, default_kind=args.kind, workers=args.workers).run()))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
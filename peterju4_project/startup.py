@@ -0,0 +1,72 @@
+"""
+Cold start report: how long a new instance takes to import main and build the app, and which imports the time
+goes to.
+
+    python startup.py                # top 25 imports by cumulative time, and time per top-level package
+    python startup.py --top 50
+    STORAGE_BACKEND=memory python startup.py
+
+Every run starts a fresh interpreter, so the numbers include what a new App Engine instance pays.
+"""
+import argparse
+import json
+import os
+import subprocess
+import sys
+
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+CHILD = 'import json, main; print(json.dumps(main.app.config["STARTUP_TIMES"]))'
+
+
+def parse_importtime(stderr):
+    """
+    :param stderr: output of python -X importtime
+    :return: list of (module, self seconds, cumulative seconds, depth), in import order
+    """
+    imports = []
+    for line in stderr.splitlines():
+        if not line.startswith("import time:") or "self [us]" in line:
+            continue
+        self_us, cumulative_us, name = line[len("import time:"):].split("|")
+        depth = (len(name) - len(name.lstrip())) // 2
+        imports.append((name.strip(), int(self_us) / 1e6, int(cumulative_us) / 1e6, depth))
+    return imports
+
+
+def run(python=sys.executable):
+    """
+    :return: startup times reported by create_app, and the import-time entries
+    """
+    result = subprocess.run([python, "-X", "importtime", "-c", CHILD], cwd=HERE, capture_output=True, text=True)
+    if result.returncode != 0:
+        raise RuntimeError(f'importing main failed:\n{result.stderr[-2000:]}')
+    return json.loads(result.stdout.strip().splitlines()[-1]), parse_importtime(result.stderr)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Cold start report for main.py")
+    parser.add_argument("--top", type=int, default=25, help="number of imports to list")
+    args = parser.parse_args(argv)
+
+    startup_times, imports = run()
+    total = sum(startup_times.values())
+    print(f'startup {total * 1000:.1f} ms: imports {startup_times["imports"] * 1000:.1f} ms, '
+          f'create_app {startup_times["create_app"] * 1000:.1f} ms')
+
+    print(f'\n{"module":<60}{"cumulative ms":>15}{"self ms":>10}')
+    for name, self_time, cumulative, depth in sorted(imports, key=lambda entry: -entry[2])[:args.top]:
+        print(f'{"  " * depth + name:<60}{cumulative * 1000:>15.1f}{self_time * 1000:>10.1f}')
+
+    packages = {}
+    for name, self_time, _, _ in imports:
+        package = name.split(".")[0]
+        packages[package] = packages.get(package, 0.0) + self_time
+    print(f'\n{"package":<60}{"self ms":>15}')
+    for package, self_time in sorted(packages.items(), key=lambda entry: -entry[1])[:args.top]:
+        print(f'{package:<60}{self_time * 1000:>15.1f}')
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,502 @@
+from contextlib import contextmanager, nullcontext
+from google.api_core.exceptions import BadRequest
+from google.cloud import datastore
+from batching import chunked, MAX_BATCH_SIZE
+from entity_cache import with_entity_cache
+from etags import ETag
+from metrics import InstrumentedBackend, register_stats
+import base64
+import copy
+import itertools
+import json
+import threading
+import constants
+
+
+class InvalidCursor(Exception):
+    pass
+
+
+class DatastoreBackend:
+    """
+    Storage backend talking to Google Cloud Datastore. The client is created on first use.
+    """
+
+    def __init__(self, client=None):
+        self._client = client
+        self._lock = threading.Lock()
+
+    @property
+    def client(self):
+        if self._client is None:
+            with self._lock:
+                if self._client is None:
+                    self._client = datastore.Client()
+        return self._client
+
+    def key(self, kind, id=None):
+        if id is None:
+            return self.client.key(kind)
+        return self.client.key(kind, id)
+
+    def get_multi(self, keys):
+        return self.client.get_multi(keys)
+
+    def put_multi(self, entities):
+        self.client.put_multi(entities)
+
+    def delete_multi(self, keys):
+        self.client.delete_multi(keys)
+
+    def allocate_ids(self, kind, count):
+        return self.client.allocate_ids(self.client.key(kind), count)
+
+    def transaction(self):
+        return self.client.transaction()
+
+    def run_query(self, kind, filters=None, order=None, projection=None, keys_only=False,
+                  limit=None, offset=0, cursor=None):
+        query = self.client.query(kind=kind)
+        for prop, op, value in filters or ():
+            query.add_filter(prop, op, value)
+        if order:
+            query.order = order
+        if projection:
+            query.projection = projection
+        if keys_only:
+            query.keys_only()
+
+        g_iterator = query.fetch(limit=limit, offset=offset, start_cursor=cursor or None)
+        try:
+            results = list(next(g_iterator.pages))
+        except (ValueError, BadRequest):
+            raise InvalidCursor(cursor)
+
+        next_cursor = g_iterator.next_page_token
+        if isinstance(next_cursor, bytes):
+            next_cursor = next_cursor.decode()
+        return results, next_cursor or None
+
+
+class MemoryBackend:
+    """
+    Thread-safe in-memory storage backend with equality indexes, for profiling and load-testing the app
+    without a Google project. Entities are stored and returned as copies, just like a round trip to Datastore.
+    """
+
+    def __init__(self, project="memory"):
+        self.project = project
+        self._entities = {}
+        self._indexes = {}
+        self._next_id = {}
+        self._lock = threading.RLock()
+
+    def key(self, kind, id=None):
+        if id is None:
+            return datastore.Key(kind, project=self.project)
+        return datastore.Key(kind, id, project=self.project)
+
+    def get_multi(self, keys):
+        with self._lock:
+            found = []
+            for key in keys:
+                entity = self._entities.get(key.kind, {}).get(key.id_or_name)
+                if entity is not None:
+                    found.append(self._copy(entity))
+            return found
+
+    def put_multi(self, entities):
+        with self._lock:
+            for entity in entities:
+                if entity.key.is_partial:
+                    entity.key = entity.key.completed_key(self._allocate(entity.key.kind, 1)[0])
+                kind = entity.key.kind
+                stored = self._entities.setdefault(kind, {})
+                previous = stored.get(entity.key.id_or_name)
+                if previous is not None:
+                    self._unindex(previous)
+                stored[entity.key.id_or_name] = self._copy(entity)
+                self._index(entity)
+
+    def delete_multi(self, keys):
+        with self._lock:
+            for key in keys:
+                entity = self._entities.get(key.kind, {}).pop(key.id_or_name, None)
+                if entity is not None:
+                    self._unindex(entity)
+
+    def allocate_ids(self, kind, count):
+        with self._lock:
+            return [self.key(kind, id) for id in self._allocate(kind, count)]
+
+    @contextmanager
+    def transaction(self):
+        # every operation takes the same re-entrant lock, so holding it makes the block atomic
+        with self._lock:
+            yield self
+
+    def run_query(self, kind, filters=None, order=None, projection=None, keys_only=False,
+                  limit=None, offset=0, cursor=None):
+        filters = list(filters or ())
+        with self._lock:
+            stored = self._entities.get(kind, {})
+            candidates = self._candidates(kind, filters)
+            rows = [stored[name] for name in candidates] if candidates is not None else list(stored.values())
+            rows = [e for e in rows if all(self._matches(e, f) for f in filters)]
+
+            required = list(projection or ()) + [prop.lstrip('-') for prop in order or ()]
+            rows = [e for e in rows if all(self._has(e, prop) for prop in required)]
+            rows.sort(key=self._sort_key)
+            for prop in reversed(order or ()):
+                rows.sort(key=lambda e: self._value_key(self._lookup(e, prop.lstrip('-'))),
+                          reverse=prop.startswith('-'))
+
+            # like Datastore's, a cursor holds the sort position of the last row returned, not its index, so
+            # rows written or deleted between pages don't shift the next page
+            start = 0
+            if cursor:
+                after = self._decode_cursor(cursor)
+                try:
+                    start = next((i for i, e in enumerate(rows)
+                                  if self._follows(self._position(e, order), after, order)), len(rows))
+                except TypeError:
+                    raise InvalidCursor(cursor)
+            start += offset
+            end = len(rows) if limit is None else min(start + limit, len(rows))
+            page = [self._copy(e, projection=projection, keys_only=keys_only) for e in rows[start:end]]
+            next_cursor = None
+            if end < len(rows):
+                next_cursor = self._encode_cursor(self._position(rows[end - 1], order)) if end > 0 else cursor
+        return page, next_cursor
+
+    def clear(self):
+        with self._lock:
+            self._entities.clear()
+            self._indexes.clear()
+
+    # ---------------------------------------------------------------------------------------------------------
+
+    def _allocate(self, kind, count):
+        first = self._next_id.get(kind, 1)
+        self._next_id[kind] = first + count
+        return list(range(first, first + count))
+
+    @staticmethod
+    def _copy(entity, projection=None, keys_only=False):
+        duplicate = datastore.Entity(key=entity.key, exclude_from_indexes=tuple(entity.exclude_from_indexes))
+        if keys_only:
+            return duplicate
+        if projection:
+            duplicate.update({prop: copy.deepcopy(entity[prop]) for prop in projection})
+        else:
+            duplicate.update(copy.deepcopy(dict(entity)))
+        return duplicate
+
+    @staticmethod
+    def _indexed_values(entity):
+        """
+        :return: (property path, value) pairs for scalar properties, properties of embedded entities
+                 ("workplace.id") and the elements of list properties
+        """
+        for prop, value in entity.items():
+            if isinstance(value, dict):
+                for sub_prop, sub_value in value.items():
+                    if not isinstance(sub_value, (dict, list)):
+                        yield f'{prop}.{sub_prop}', sub_value
+            elif isinstance(value, list):
+                for element in value:
+                    if not isinstance(element, (dict, list)):
+                        yield prop, element
+            else:
+                yield prop, value
+
+    def _index(self, entity):
+        indexes = self._indexes.setdefault(entity.key.kind, {})
+        for prop, value in self._indexed_values(entity):
+            indexes.setdefault(prop, {}).setdefault(value, set()).add(entity.key.id_or_name)
+
+    def _unindex(self, entity):
+        indexes = self._indexes.get(entity.key.kind, {})
+        for prop, value in self._indexed_values(entity):
+            names = indexes.get(prop, {}).get(value)
+            if names is not None:
+                names.discard(entity.key.id_or_name)
+                if not names:
+                    del indexes[prop][value]
+
+    def _candidates(self, kind, filters):
+        """
+        :return: ids matching every equality filter according to the indexes, or None if there is none
+        """
+        candidates = None
+        indexes = self._indexes.get(kind, {})
+        for prop, op, value in filters:
+            if op != "=":
+                continue
+            names = indexes.get(prop, {}).get(value, set())
+            candidates = set(names) if candidates is None else candidates & names
+        return candidates
+
+    @staticmethod
+    def _lookup(entity, prop):
+        value = entity
+        for part in prop.split('.'):
+            if not isinstance(value, dict) or part not in value:
+                return None
+            value = value[part]
+        return value
+
+    @staticmethod
+    def _has(entity, prop):
+        value = entity
+        for part in prop.split('.'):
+            if not isinstance(value, dict) or part not in value:
+                return False
+            value = value[part]
+        return True
+
+    @staticmethod
+    def _matches(entity, query_filter):
+        prop, op, value = query_filter
+        if not MemoryBackend._has(entity, prop):
+            return False
+        actual = MemoryBackend._lookup(entity, prop)
+        values = actual if isinstance(actual, list) else [actual]
+        for candidate in values:
+            if op == "=" and candidate == value:
+                return True
+            if candidate is None or value is None or op == "=":
+                continue
+            try:
+                if ((op == "<" and candidate < value) or (op == "<=" and candidate <= value)
+                        or (op == ">" and candidate > value) or (op == ">=" and candidate >= value)
+                        or (op == "!=" and candidate != value)):
+                    return True
+            except TypeError:
+                continue
+        return False
+
+    @staticmethod
+    def _value_key(value):
+        # Datastore orders values of different types by type: null, numbers, strings, everything else
+        if value is None:
+            return 0, 0
+        if isinstance(value, (bool, int, float)):
+            return 1, value
+        if isinstance(value, str):
+            return 2, value
+        return 3, str(value)
+
+    @staticmethod
+    def _sort_key(entity):
+        id_or_name = entity.key.id_or_name
+        return (0, id_or_name, "") if isinstance(id_or_name, int) else (1, 0, id_or_name)
+
+    @staticmethod
+    def _position(entity, order):
+        """
+        :return: where the entity sorts in a query with the given order: its ordered values, then its key
+        """
+        values = [MemoryBackend._value_key(MemoryBackend._lookup(entity, prop.lstrip('-'))) for prop in order or ()]
+        return [list(value) for value in values] + [list(MemoryBackend._sort_key(entity))]
+
+    @staticmethod
+    def _follows(position, after, order):
+        """
+        :return: True if a row at `position` comes after one at `after` in a query with the given order
+        """
+        descending = [prop.startswith('-') for prop in order or ()] + [False]
+        for value, other, reverse in zip(position, after, descending):
+            if value != other:
+                return (value < other) if reverse else (value > other)
+        return False
+
+    @staticmethod
+    def _encode_cursor(position):
+        return base64.urlsafe_b64encode(json.dumps(position).encode()).decode()
+
+    @staticmethod
+    def _decode_cursor(cursor):
+        try:
+            position = json.loads(base64.urlsafe_b64decode(cursor.encode()).decode())
+        except ValueError:
+            raise InvalidCursor(cursor)
+        if not isinstance(position, list) or not all(isinstance(value, list) for value in position):
+            raise InvalidCursor(cursor)
+        return position
+
+
+class Repository:
+    """
+    get/put/delete/query access to the entities of one kind. Multi-entity calls are split into batches that
+    fit Datastore's per-call limits.
+    """
+
+    def __init__(self, kind):
+        self.kind = kind
+
+    @property
+    def backend(self):
+        return get_backend()
+
+    def key(self, id=None):
+        return self.backend.key(self.kind, id)
+
+    def new(self, id=None, exclude_from_indexes=()):
+        """
+        :param id: id or name of the new entity; None lets the backend allocate an id on put
+        :param exclude_from_indexes: properties that are never filtered on
+        :return: an empty entity of this kind
+        """
+        return datastore.Entity(key=self.key(id), exclude_from_indexes=exclude_from_indexes)
+
+    def get(self, id):
+        entities = self.backend.get_multi([self.key(id)])
+        return entities[0] if entities else None
+
+    def get_multi(self, ids):
+        """
+        :param ids: ids or names of the entities
+        :return: the entities found, missing ones are skipped
+        """
+        entities = []
+        for chunk in chunked(ids, MAX_BATCH_SIZE):
+            entities.extend(self.backend.get_multi([self.key(id) for id in chunk]))
+        return entities
+
+    def put(self, entity):
+        if self.kind in constants.ETAG_KINDS:
+            ETag.stamp(entity)
+        self.backend.put_multi([entity])
+
+    def put_multi(self, entities):
+        if self.kind in constants.ETAG_KINDS:
+            for entity in entities:
+                ETag.stamp(entity)
+        for chunk in chunked(entities, MAX_BATCH_SIZE):
+            self.backend.put_multi(chunk)
+
+    def delete(self, id):
+        self.backend.delete_multi([self.key(id)])
+
+    def delete_multi(self, ids):
+        for chunk in chunked(ids, MAX_BATCH_SIZE):
+            self.backend.delete_multi([self.key(id) for id in chunk])
+
+    def allocate_ids(self, count):
+        """
+        :param count: number of ids to reserve
+        :return: list of reserved ids
+        """
+        return [key.id for key in self.backend.allocate_ids(self.kind, count)]
+
+    def query(self, filters=None, order=None, projection=None, keys_only=False, limit=None, offset=0, cursor=None):
+        """
+        Runs one page of a query
+        :param filters: list of (property, operator, value) tuples; embedded properties as "workplace.id"
+        :param order: list of properties, prefixed with "-" for descending order
+        :param projection: list of properties to return
+        :param keys_only: return entities without properties
+        :param limit: page size
+        :param offset: entities to skip (prefer cursor)
+        :param cursor: opaque cursor returned by the previous page
+        :return: list of entities, cursor of the next page (None on the last page)
+        """
+        return self.backend.run_query(self.kind, filters=filters, order=order, projection=projection,
+                                      keys_only=keys_only, limit=limit, offset=offset, cursor=cursor)
+
+    def iterate(self, filters=None, keys_only=False, batch_size=MAX_BATCH_SIZE):
+        """
+        Walks every entity matching the filters, one cursor-addressed batch at a time
+        :return: generator of entities
+        """
+        cursor = None
+        while True:
+            results, cursor = self.query(filters=filters, keys_only=keys_only, limit=batch_size, cursor=cursor)
+            yield from results
+            if not cursor or not results:
+                return
+
+    def count(self, filters=None, limit=None):
+        """
+        Counts the entities matching the filters with a keys-only walk, which reads no properties
+        :param limit: stop counting once this many are found
+        :return: number of matching entities, at most limit
+        """
+        keys = self.iterate(filters=filters, keys_only=True)
+        return sum(1 for _ in (keys if limit is None else itertools.islice(keys, limit)))
+
+
+_backend = None
+_backend_lock = threading.Lock()
+
+
+def get_backend():
+    """
+    :return: the process-wide storage backend selected by constants.STORAGE_BACKEND, built on first use
+    """
+    global _backend
+    if _backend is None:
+        with _backend_lock:
+            if _backend is None:
+                if constants.STORAGE_BACKEND == "memory":
+                    backend = MemoryBackend()
+                elif constants.STORAGE_BACKEND == "datastore":
+                    backend = DatastoreBackend()
+                else:
+                    raise ValueError(f'Unknown storage backend: {constants.STORAGE_BACKEND}')
+                _backend = with_entity_cache(InstrumentedBackend(backend))
+    return _backend
+
+
+def set_backend(backend):
+    """
+    Replaces the process-wide backend, e.g. with a MemoryBackend for load tests. The entity cache is put in
+    front of it as configured.
+    """
+    global _backend
+    with _backend_lock:
+        _backend = with_entity_cache(InstrumentedBackend(backend))
+
+
+def entity_cache_stats():
+    """
+    :return: hit/miss/eviction counters of the entity cache, or None if it is disabled
+    """
+    backend = get_backend()
+    return backend.stats() if hasattr(backend, "store") else None
+
+
+register_stats("entity_cache", entity_cache_stats)
+
+
+def get_multi(keys):
+    """
+    Looks up entities of any kinds together, one backend call per MAX_BATCH_SIZE keys
+    :param keys: complete keys, e.g. from Repository.key
+    :return: the entities found, missing ones are skipped
+    """
+    entities = []
+    for chunk in chunked(keys, MAX_BATCH_SIZE):
+        entities.extend(get_backend().get_multi(chunk))
+    return entities
+
+
+def uncached():
+    """
+    :return: context manager sending the lookups by key in its block past the entity cache, for reads that are
+             modified and written back
+    """
+    backend = get_backend()
+    return backend.uncached() if hasattr(backend, "store") else nullcontext()
+
+
+def transaction():
+    """
+    :return: context manager making the repository calls in its block atomic
+    """
+    return get_backend().transaction()
+
+
+def repository(kind):
+    return Repository(kind)
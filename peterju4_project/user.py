@@ -1,30 +1,92 @@
 from flask import Blueprint, request
-from google.cloud import datastore
+import storage
+from batching import BatchOperations, chunked
+from cache import LRUCache
+import jobs
 from entity_processing import EntityProcessing, ContentValidation
 import json
 import constants
 
 
-client = datastore.Client()
+user_repo = storage.repository(constants.users)
+
+# subs known to have a user entity, so return visitors don't hit Datastore at all
+known_subs = LRUCache(constants.KNOWN_SUBS_CACHE_SIZE)
 
 bp = Blueprint('user', __name__, url_prefix='/users')
 
 
+def ensure_user(sub):
+    """
+    Makes sure a user entity exists for the sub. Users are keyed by their sub, so this is a single point lookup.
+    :param sub: "sub" claim of the logged in user
+    :return: True if the user was created, False if they already existed
+    """
+    if known_subs.get(sub):
+        return False
+
+    created = False
+    if user_repo.get(sub) is None:
+        # users created before keys were derived from the sub are found by an equality filter and re-keyed
+        legacy_users, _ = user_repo.query(filters=[("sub", "=", sub)], keys_only=True, limit=1)
+
+        new_user = user_repo.new(sub)
+        new_user.update({'sub': sub})
+        user_repo.put(new_user)
+        if legacy_users:
+            user_repo.delete(legacy_users[0].key.id_or_name)
+        else:
+            created = True
+
+    known_subs.set(sub, True)
+    return created
+
+
+def migrate_user_keys(progress=None):
+    """
+    One-off migration: re-keys every user entity with a numeric id under a key named by its sub
+    :param progress: optional callable receiving the number of users migrated so far
+    :return: number of users migrated
+    """
+    migrated = 0
+    for batch in chunked(user_repo.iterate()):
+        legacy_users = [e for e in batch if e.key.id is not None]
+        if not legacy_users:
+            continue
+        new_users = []
+        for legacy_user in legacy_users:
+            new_user = user_repo.new(legacy_user["sub"])
+            new_user.update(legacy_user)
+            new_users.append(new_user)
+        user_repo.put_multi(new_users)
+        user_repo.delete_multi([e.key.id for e in legacy_users])
+        migrated += len(legacy_users)
+        if progress:
+            progress(migrated)
+    return migrated
+
+
+def _delete_all(progress=None):
+    deleted = BatchOperations.delete_all(user_repo, progress=progress)
+    known_subs.clear()
+    return deleted
+
+
+jobs.runner.register("delete-all-users", _delete_all)
+
+
 @bp.route('/all', methods=['DELETE'])
 def users_delete_all():
     if "application/json" not in request.accept_mimetypes:
         return {"Error": "This endpoint only supports the return of JSON objects"}, 406
 
     if request.method == "DELETE":
-        query = client.query(kind=constants.users)
-        results = list(query.fetch())
-        print(results)
-        for e in results:
-            user_key = client.key(constants.users, int(e.key.id))
-            client.delete(user_key)
-        query = client.query(kind=constants.users)
-        results = list(query.fetch())
-        print(results)
+        # ?background=true runs large wipes as a job that can be polled at /jobs/<id>
+        if request.args.get('background', 'false').lower() == 'true':
+            job = jobs.runner.submit("delete-all-users")
+            return {"id": job["id"], "self": f'{request.host_url}jobs/{job["id"]}'}, 202
+
+        _delete_all()
         return {"Success": "Deleted all users"}, 204
 
 
@@ -35,7 +97,12 @@ def users_get():
 
         # View all employees
     if request.method == 'GET':
-        query = client.query(kind=constants.users)
-        results = list(query.fetch())
+        results = list(user_repo.iterate())
         return json.dumps(results)
 
+
+if __name__ == '__main__':
+    # python user.py migrate
+    import sys
+    if sys.argv[1:] == ['migrate']:
+        print(f'Migrated {migrate_user_keys()} users')